@@ -65,7 +65,7 @@ class Portfolio extends React.Component {
                     <React.Fragment>
                         <img
                             style={{ float: "right", maxWidth: "50%", margin: "10px" }}
-                            src={`data:image/png;base64,${portfolio.efficientFrontierImage}`}
+                            src={`api/efficientFrontierImage/${portfolio.efficientFrontierImageId}`}
                             alt="Efficient Frontier Plot"
                         />
                         <Typography variant="body1" component="h2" style={{ margin: "15px", marginTop: "75px" }}>
@@ -176,7 +176,7 @@ class Portfolio extends React.Component {
         const { portfolio } = this.props;
 
         const a = document.createElement("a");
-        a.href = `data:image/png;base64,${portfolio["efficientFrontierImage"]}`;
+        a.href = `api/efficientFrontierImage/${portfolio["efficientFrontierImageId"]}`;
         a.download = "EfficientFrontier.png";
         a.click();
     };
@@ -35,6 +35,7 @@ class Search extends React.Component {
         shorting: false,
         removeTER: true,
         rollingWindowInDays: 0,
+        covarianceModel: "sample",
         maxETFListSize: 400,
     };
 
@@ -164,6 +165,27 @@ class Search extends React.Component {
                                 style={{ margin: "5px", width: "175px" }}
                                 onChange={(e) => this.handleChangeOptimizerParameter(parseInt(e.target.value), "rollingWindowInDays")}
                             />
+                            <FormControl style={{ margin: "5px" }}>
+                                <InputLabel id="covarianceModel">Covariance Model</InputLabel>
+                                <Select
+                                    labelId="covarianceModel"
+                                    id="covarianceModel-select"
+                                    value={
+                                        parameters.covarianceModels && optimizerParameters.covarianceModel != null
+                                            ? optimizerParameters.covarianceModel
+                                            : ""
+                                    }
+                                    style={{ width: "135px" }}
+                                    onChange={(e) => this.handleChangeCovarianceModel(e.target.value)}
+                                >
+                                    {parameters.covarianceModels &&
+                                        parameters.covarianceModels.map((option, index) => (
+                                            <MenuItem key={option} value={option}>
+                                                {option}
+                                            </MenuItem>
+                                        ))}
+                                </Select>
+                            </FormControl>
                             <TextField
                                 id="maxETFListSize"
                                 label="Max ETF list size"
@@ -396,6 +418,18 @@ class Search extends React.Component {
         this.setState({ optimizerParameters: newOptimizerParameters });
     };
 
+    handleChangeCovarianceModel = (covarianceModel) => {
+        const { optimizerParameters, parameters } = this.state;
+        let newOptimizerParameters = { ...optimizerParameters, covarianceModel: covarianceModel };
+
+        // Each covariance model scales to a different number of ETFs
+        if (parameters.maxETFListSizes && parameters.maxETFListSizes[covarianceModel] != null) {
+            newOptimizerParameters.maxETFListSize = parameters.maxETFListSizes[covarianceModel];
+        }
+
+        this.setState({ optimizerParameters: newOptimizerParameters });
+    };
+
     handleChangeETFFilters = (value, filterName) => {
         const { etfFilters } = this.state;
         let newETFFilters = { ...etfFilters };
@@ -1,13 +1,36 @@
-class ETF:
+import numpy as np
 
-    _id = ""
-    data = {}
-    historical_data = []
 
-    def __init__(self, _id, data, historical_data):
+class ETF:
+    """ The metadata the optimizer reads is kept in typed fields next to the raw justETF data, and the history is held
+        as numpy arrays of datetime64[D] dates and float64 closes instead of a dict per day."""
+
+    __slots__ = ("_id", "data", "name", "isin", "domicile_country", "replication_method", "distribution_policy",
+                 "fund_currency", "ter", "dates", "closes", "days_with_data", "last_date")
+
+    name: str
+    isin: str
+    domicile_country: str
+    replication_method: str
+    distribution_policy: str
+    fund_currency: str
+    dates: np.ndarray
+    closes: np.ndarray
+
+    def __init__(self, _id, data, historical_data, days_with_data=None, last_date=None):
+        """ historical_data is either a list of {"date", "close"} dicts or a tuple of dates and closes arrays."""
         self._id = _id
         self.data = data
-        self.historical_data = historical_data
+        self.name = data.get("name")
+        self.isin = data.get("isin")
+        self.domicile_country = data.get("domicileCountry")
+        self.replication_method = data.get("replicationMethod")
+        self.distribution_policy = data.get("distributionPolicy")
+        self.fund_currency = data.get("fundCurrency")
+        self.ter = None
+        self.dates, self.closes = get_history_arrays(historical_data)
+        self.days_with_data = days_with_data
+        self.last_date = last_date
 
     def get_id(self):
         return self._id
@@ -16,28 +39,30 @@ class ETF:
         return self.data
 
     def get_name(self):
-        return self.data["name"]
+        return self.name
 
     def get_isin(self):
-        return self.data["isin"]
+        return self.isin
 
     def get_ticker(self):
         return self.data["ticker"]
 
     def get_ter(self):
-        return float(self.data["ter"][:-1]) * 0.01
+        if self.ter is None:
+            self.ter = float(self.data["ter"][:-1]) * 0.01
+        return self.ter
 
     def get_domicile_country(self):
-        return self.data["domicileCountry"]
+        return self.domicile_country
 
     def get_replication_method(self):
-        return self.data["replicationMethod"]
+        return self.replication_method
 
     def get_distribution_policy(self):
-        return self.data["distributionPolicy"]
+        return self.distribution_policy
 
     def get_fund_currency(self):
-        return self.data["fundCurrency"]
+        return self.fund_currency
 
     def get_rics(self):
         if "RICs" in self.data:
@@ -53,26 +78,70 @@ class ETF:
     def get_no_data_found(self):
         return self.data.get("noDataFound", False)
 
+    def set_historical_data_ric(self, ric):
+        self.data["historicalDataRIC"] = ric
+
+    def get_historical_data_ric(self):
+        """ The RIC the stored history was fetched from, None for ETFs fetched before it was recorded."""
+        return self.data.get("historicalDataRIC")
+
     def set_historical_data(self, historical_data):
-        self.historical_data = historical_data
+        self.dates, self.closes = get_history_arrays(historical_data)
+        self.days_with_data = None
+        self.last_date = None
 
     def get_historical_data(self):
-        return self.historical_data
+        """ The history as a list of {"date", "close"} dicts, built from the arrays on every call."""
+        return [{"date": date, "close": close} for date, close in zip(self.dates.astype(str).tolist(),
+                                                                      self.closes.tolist())]
+
+    def get_dates(self):
+        return self.dates
+
+    def get_closes(self):
+        return self.closes
+
+    def get_days_with_data(self):
+        """ ETFs loaded from a prices snapshot or without their prices don't carry their historical data, only how many
+            days it had."""
+        if self.days_with_data is not None:
+            return self.days_with_data
+        return len(self.dates)
+
+    def get_last_date(self):
+        if self.last_date is not None:
+            return self.last_date
+        if len(self.dates) > 0:
+            return str(self.dates[-1])
+        return None
 
     def to_json(self):
         as_json = {
             "data": self.data,
-            "historicalData": self.historical_data
+            "historicalData": self.get_historical_data()
         }
         return as_json
 
 
+def get_history_arrays(historical_data):
+    if isinstance(historical_data, tuple):
+        dates, closes = historical_data
+        return np.asarray(dates, dtype="datetime64[D]"), np.asarray(closes, dtype=np.float64)
+
+    dates = np.array([date_price["date"] for date_price in historical_data], dtype="datetime64[D]")
+    closes = np.array([date_price["close"] for date_price in historical_data], dtype=np.float64)
+    return dates, closes
+
+
 def get_etf_list_from_json(json_data):
     etf_list = []
 
     for d in json_data:
         if "_id" in d and "data" in d and "historicalData" in d:
             etf_list.append(ETF(d["_id"], d["data"], d["historicalData"]))
+        elif "_id" in d and "data" in d:
+            # The prices of the ETF are stored apart from its document
+            etf_list.append(ETF(d["_id"], d["data"], [], d.get("daysWithData", 0), d.get("lastDate")))
         else:
             etf_list.append(ETF("", d, {}))
 
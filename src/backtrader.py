@@ -1,79 +1,244 @@
 import optimizer
 import ETF
+import covarianceModels
+import timing
+from rollingCovariance import RollingCovariance
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 import pandas
 import numpy as np
+import base64
+import io
+import os
+import threading
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
-import pypfopt
-from timeit import default_timer
-import matplotlib.pyplot as plt
 
 INITIAL_VALUE = 100000
 STARTING_DATE = "2010-01-01"
 REBALANCE_PERIOD_IN_MONTHS = 12
+PARALLEL = False
+EMBED_IMAGE = False
 
+BACKTRADE_WORKERS = int(os.environ.get('BACKTRADE_WORKERS', os.cpu_count() or 1))
 
-def backtrade(etf_list, prices_df, optimizer_parameters, etf_filters, backtrade_parameters):
+# Shared by every parallel backtrade, so concurrent ones don't each start their own processes
+_solve_executor = None
+_solve_executor_lock = threading.Lock()
+
+
+def backtrade(dataset, optimizer_parameters, etf_filters, backtrade_parameters, progress_callback=None):
 
     initial_value = backtrade_parameters.get("initialValue", INITIAL_VALUE)
     starting_date = backtrade_parameters.get("startingDate", STARTING_DATE)
     rebalance_period = backtrade_parameters.get("rebalancePeriod", REBALANCE_PERIOD_IN_MONTHS)
+    parallel = backtrade_parameters.get("parallel", PARALLEL)
+    ending_date = backtrade_parameters.get("endingDate", None)
+    embed_image = backtrade_parameters.get("embedImage", EMBED_IMAGE)
 
     optimizer_parameters["nEFPlottingPoints"] = 0  # No need to plot with backtrading
 
-    start = default_timer()
+    with timing.span("backtrade") as backtrade_span:
+        value = initial_value
+        starting_date = datetime.strptime(starting_date, '%Y-%m-%d').date()
+        trading_history = [{"date": starting_date, "result": None, "value": value}]
 
-    value = initial_value
-    starting_date = datetime.strptime(starting_date, '%Y-%m-%d').date()
-    date = starting_date
-    trading_history = [{"date": date, "result": None, "value": value}]
+        if ending_date is None:
+            ending_date = datetime.today().date()
+        else:
+            ending_date = datetime.strptime(ending_date, '%Y-%m-%d').date()
 
-    today = datetime.today().date()
-    while date < today:
-        optimizer_parameters["finalDate"] = date
-        optimizer_parameters["initialValue"] = value
-        result = optimizer.optimize(etf_list, prices_df, optimizer_parameters, etf_filters)
+        rebalance_periods = get_rebalance_periods(starting_date, rebalance_period, ending_date)
+
+        etf_list = optimizer.filter_etfs_using_filters(dataset.etf_index, etf_filters)
+
+        # The rebalance windows overlap almost completely, so the sample covariance is moved forward instead of
+        # recomputed
+        covariance_engine = None
+        if optimizer_parameters.get("covarianceModel", optimizer.COVARIANCE_MODEL) == "sample":
+            with timing.span("covarianceEngine"):
+                covariance_engine = get_covariance_engine(dataset)
+
+        forward_filled_prices = ForwardFilledPrices(dataset.prices_df)
+
+        workers = BACKTRADE_WORKERS if parallel else 1
+        rebalances = get_optimized_rebalances(dataset, etf_list, optimizer_parameters, covariance_engine,
+                                              rebalance_periods, workers)
+
+        for step, rebalance in enumerate(rebalances):
+            (date, next_rebalance), parameters, returns, cov, latest_prices, weights, performance = rebalance
+            parameters["initialValue"] = value
+            volatility = covarianceModels.get_volatility(cov)
+
+            result = optimizer.get_portfolio_and_performance(weights, performance, latest_prices, parameters, returns,
+                                                             volatility)
+            result["ETFsMatchingFilters"] = len(etf_list)
+            result["ETFsUsedForOptimization"] = len(etf_list)
+
+            with timing.span("backtradeValuation"):
+                weekly_dates = get_weekly_dates(date, next_rebalance)
+                values = forward_filled_prices.get_portfolio_values(weekly_dates, result["portfolio"]) + \
+                    result["leftoverFunds"]
 
+            for date, value in zip(weekly_dates, values.tolist()):
+                trading_history.append({"date": date, "result": result, "value": value})
+
+            if progress_callback is not None:
+                progress_callback(step + 1, len(rebalance_periods))
+
+        risk_free_rate = optimizer_parameters.get("riskFreeRate", optimizer.RISK_FREE_RATE)
+        performance = calculate_performance(trading_history, risk_free_rate)
+
+        result = {"performance": performance, "finalValue": value, "tradingHistory": trading_history}
+
+        if embed_image:
+            with timing.span("backtradePlot"):
+                image = render_trading_history_image(starting_date, initial_value, trading_history, performance)
+            result["backtradingImage"] = base64.b64encode(image).decode("ascii")
+
+    print("Time to run backtrading {}".format(backtrade_span.seconds))
+
+    return result
+
+
+def get_rebalance_periods(starting_date, rebalance_period, today):
+    rebalance_periods = []
+
+    date = starting_date
+    while date < today:
         next_rebalance = date + relativedelta(months=rebalance_period)
 
         if next_rebalance > today:
             next_rebalance = today
 
-        while date < next_rebalance:
-            date += relativedelta(days=7)
+        rebalance_periods.append((date, next_rebalance))
+        date = next_rebalance
 
-            if date > next_rebalance:
-                date = next_rebalance
+    return rebalance_periods
 
-            value = get_portfolio_value_at_date(prices_df, date, result["portfolio"]) + result["leftoverFunds"]
-            trading_history.append({"date": date, "result": result, "value": value})
 
-    risk_free_rate = optimizer_parameters.get("riskFreeRate", optimizer.RISK_FREE_RATE)
-    performance = calculate_performance(trading_history, risk_free_rate)
+def get_optimized_rebalances(dataset, etf_list, optimizer_parameters, covariance_engine, rebalance_periods, workers):
+    """ Yields the optimized weights of every rebalance in order. The weights don't depend on the value of the portfolio,
+        so with more than one worker the solves run ahead in the shared process pool while the caller values the
+        portfolio. Returns and covariance are still computed here, in order, as the covariance engine only moves
+        forward."""
 
-    plot_trading_history(starting_date, initial_value, trading_history, performance)
+    def prepare(rebalance_period):
+        parameters = dict(optimizer_parameters, finalDate=rebalance_period[0])
+        returns, cov, latest_prices = optimizer.get_returns_and_covariance(dataset, etf_list, parameters,
+                                                                           covariance_engine, use_cache=False)
+        return rebalance_period, parameters, returns, cov, latest_prices
 
-    end = default_timer()
-    print("Time to run backtrading {}".format(end - start))
+    if workers <= 1:
+        for rebalance_period in rebalance_periods:
+            rebalance = prepare(rebalance_period)
+            weights, performance = optimizer.get_optimized_weights(rebalance[2], rebalance[3], rebalance[1])
+            yield rebalance + (weights, performance)
+        return
 
-    return {"performance": performance, "finalValue": value, "tradingHistory": trading_history}
+    executor = get_solve_executor()
+    pending = deque()
+    try:
+        for rebalance_period in rebalance_periods:
+            rebalance = prepare(rebalance_period)
+            pending.append((rebalance, executor.submit(optimizer.get_optimized_weights, rebalance[2], rebalance[3],
+                                                       rebalance[1])))
 
+            # Bounds how many covariance matrices are kept around waiting for a worker
+            if len(pending) > 2 * workers:
+                rebalance, solve = pending.popleft()
+                yield rebalance + wait_for_solve(executor, solve)
 
-def get_portfolio_value_at_date(prices_df, date, portfolio):
-    prices_until_date = prices_df.loc[:str(date)]
+        while len(pending) > 0:
+            rebalance, solve = pending.popleft()
+            yield rebalance + wait_for_solve(executor, solve)
+    finally:
+        # A backtrade that failed or was cancelled doesn't leave its solves queued in the shared pool
+        for rebalance, solve in pending:
+            solve.cancel()
 
-    latest_prices = pypfopt.discrete_allocation.get_latest_prices(prices_until_date)
 
-    total_value = 0
-    for etf in portfolio:
-        etf_identifier = ETF.get_combined_name_and_isin(etf["name"], etf["isin"])
+def get_solve_executor():
+    """ Started from the forkserver rather than forked from the server and its threads. The solves only depend on their
+        arguments, so the workers don't need anything from the server."""
+    global _solve_executor
 
-        total_value += latest_prices[etf_identifier] * etf["shares"]
+    with _solve_executor_lock:
+        if _solve_executor is None:
+            _solve_executor = ProcessPoolExecutor(max_workers=BACKTRADE_WORKERS,
+                                                  mp_context=multiprocessing.get_context("forkserver"))
+        return _solve_executor
 
-    return total_value
+
+def wait_for_solve(executor, solve):
+    """ The spans of the solve are in the worker process, only the time spent waiting for it is seen here."""
+    global _solve_executor
+
+    try:
+        with timing.span("solveWait"):
+            return solve.result()
+    except BrokenProcessPool:
+        # A broken pool fails every task, the next backtrade starts a new one
+        with _solve_executor_lock:
+            if _solve_executor is executor:
+                _solve_executor = None
+        raise
+
+
+def get_covariance_engine(dataset):
+    """ The engine tracks the ETFs of the rebalance windows as they come, at most the maximum ETF list size of each
+        window rather than every ETF matching the filters."""
+    return RollingCovariance(dataset.prices_df)
+
+
+def get_weekly_dates(date, next_rebalance):
+    weekly_dates = []
+
+    while date < next_rebalance:
+        date += relativedelta(days=7)
+
+        if date > next_rebalance:
+            date = next_rebalance
+
+        weekly_dates.append(date)
+
+    return weekly_dates
+
+
+class ForwardFilledPrices:
+    """ Latest known price of every ETF at any date. Each ETF is forward-filled once per backtrade, the first time a
+        portfolio holds it, instead of forward-filling the whole prefix of the data frame for every valuation."""
+
+    def __init__(self, prices_df):
+        self.prices_df = prices_df
+        self.dates = prices_df.index.to_numpy(dtype=str)
+        self.columns = {}
+
+    def get_column(self, identifier):
+        if identifier not in self.columns:
+            self.columns[identifier] = self.prices_df[identifier].ffill().to_numpy(dtype=np.float64)
+        return self.columns[identifier]
+
+    def get_portfolio_values(self, dates, portfolio):
+        rows = np.searchsorted(self.dates, [str(date) for date in dates], side="right") - 1
+
+        values = np.zeros(len(rows))
+        if len(portfolio) > 0:
+            identifiers = [ETF.get_combined_name_and_isin(etf["name"], etf["isin"]) for etf in portfolio]
+            shares = np.array([etf["shares"] for etf in portfolio], dtype=np.float64)
+
+            prices = np.column_stack([self.get_column(identifier)[rows] for identifier in identifiers])
+            values = prices @ shares
+
+        # Dates before the first price have no value
+        return np.where(rows >= 0, values, np.nan)
 
 
 def calculate_performance(trading_history, risk_free_rate):
+    from pypfopt import risk_models
+
     starting_date = trading_history[0]["date"]
     end_date = trading_history[-1]["date"]
     initial_value = trading_history[0]["value"]
@@ -88,7 +253,7 @@ def calculate_performance(trading_history, risk_free_rate):
 
     values_df = pandas.DataFrame(value_history)
 
-    cov = pypfopt.risk_models.sample_cov(values_df, frequency=36)
+    cov = risk_models.sample_cov(values_df, frequency=36)
     vol_series = pandas.Series(np.sqrt(np.diag(cov)), index=cov.index)
     volatility = vol_series[0] * 100
 
@@ -101,7 +266,12 @@ def calculate_performance(trading_history, risk_free_rate):
     }
 
 
-def plot_trading_history(starting_date, initial_value, trading_history, performance):
+def render_trading_history_image(starting_date, initial_value, trading_history, performance):
+    """ PNG of the value of the portfolio over time. Every backtrade draws on its own figure, so backtrades running at
+        the same time don't draw over each other."""
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
     dates = [starting_date]
     values = [initial_value]
 
@@ -109,14 +279,20 @@ def plot_trading_history(starting_date, initial_value, trading_history, performa
         dates.append(history["date"])
         values.append(history["value"])
 
-    plt.switch_backend('agg')
-    plt.plot(dates, values, "-")
-    plt.title("Backtrading history")
-    plt.xlabel('Date')
-    plt.ylabel('Portfolio Value')
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+
+    ax.plot(dates, values, "-")
+    ax.set_title("Backtrading history")
+    ax.set_xlabel('Date')
+    ax.set_ylabel('Portfolio Value')
 
-    plt.annotate('Annualized return: {0:.2f}%'.format(performance["annualizedReturn"]), xy=(0.05, 0.95), xycoords='axes fraction')
-    plt.annotate('Volatility: {0:.2f}%'.format(performance["volatility"]), xy=(0.05, 0.90), xycoords='axes fraction')
-    plt.annotate('Sharpe ratio: {0:.2f}'.format(performance["sharpeRatio"]), xy=(0.05, 0.85), xycoords='axes fraction')
+    ax.annotate('Annualized return: {0:.2f}%'.format(performance["annualizedReturn"]), xy=(0.05, 0.95),
+                xycoords='axes fraction')
+    ax.annotate('Volatility: {0:.2f}%'.format(performance["volatility"]), xy=(0.05, 0.90), xycoords='axes fraction')
+    ax.annotate('Sharpe ratio: {0:.2f}'.format(performance["sharpeRatio"]), xy=(0.05, 0.85), xycoords='axes fraction')
 
-    plt.savefig('misc/backtrading.png')
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png")
+    return buf.getvalue()
@@ -0,0 +1,294 @@
+from ETF import get_etf_list_from_json
+from dataset import Dataset
+import backtrader
+import covarianceModels
+import optimizer
+import prices
+import contextlib
+import io
+import json
+import numpy as np
+import os
+import platform
+import subprocess
+import sys
+from datetime import date, datetime
+from timeit import default_timer as timer
+
+BENCHMARK_SIZES = [100, 1000, 5000]
+BENCHMARK_SEED = 0
+# Fixed, so the universes and the backtest periods are the same whenever the benchmark runs
+BENCHMARK_END_DATE = date(2024, 12, 31)
+BENCHMARK_OUTPUT = "benchmark.json"
+HISTORY_IN_YEARS = 15
+BACKTEST_IN_YEARS = 10
+FILTER_REPEATS = 10
+
+DOMICILE_COUNTRIES = ["Ireland", "Luxembourg", "Germany", "France", "Switzerland"]
+REPLICATION_METHODS = ["Full replication", "Optimized sampling", "Swap-based"]
+DISTRIBUTION_POLICIES = ["Accumulating", "Distributing"]
+FUND_CURRENCIES = ["EUR", "USD", "GBP", "CHF", "JPY"]
+
+# Filters of the filtering stage, from none to all of them
+BENCHMARK_FILTERS = [
+    {},
+    {"minimumDaysWithData": 1000},
+    {"minimumDaysWithData": 1000, "domicileCountry": "Ireland", "distributionPolicy": "Accumulating"},
+    {"minimumDaysWithData": 500, "domicileCountry": "Luxembourg", "replicationMethod": "Swap-based",
+     "distributionPolicy": "Distributing", "fundCurrency": "USD"}
+]
+
+
+def main():
+    """ Usage:
+            python benchmark.py run [output.json] [size ...]
+            python benchmark.py compare base.json new.json"""
+    if len(sys.argv) > 1 and sys.argv[1] == "compare":
+        compare_results(load_results(sys.argv[2]), load_results(sys.argv[3]))
+        return
+
+    output = sys.argv[2] if len(sys.argv) > 2 else BENCHMARK_OUTPUT
+    sizes = [int(size) for size in sys.argv[3:]] or BENCHMARK_SIZES
+
+    results = run_benchmarks(sizes, BENCHMARK_SEED)
+
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print("Benchmark results written to {}".format(output))
+
+
+def run_benchmarks(sizes, seed):
+    """ Runs every stage on a synthetic universe of each size. The universes only depend on the seed, and the smaller
+        ones are the first ETFs of the bigger ones."""
+    end_date = BENCHMARK_END_DATE
+
+    results = {
+        "createdAt": datetime.now().isoformat(timespec="seconds"),
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "packages": get_package_versions(),
+        "seed": seed,
+        "endDate": str(end_date),
+        "universes": []
+    }
+
+    for size in sizes:
+        print()
+        print("Benchmark of {} ETFs".format(size))
+        universe = run_benchmark(size, seed, end_date)
+        for stage, seconds in universe["stages"].items():
+            if seconds is None:
+                print("    {:<40} {:>10} {}".format(stage, "failed", universe["errors"][stage]))
+            else:
+                print("    {:<40} {:>10.3f}s".format(stage, seconds))
+
+        results["universes"].append(universe)
+
+    return results
+
+
+def run_benchmark(size, seed, end_date):
+    stages = {}
+    errors = {}
+
+    # The documents are converted as they're generated, the whole universe as dicts doesn't fit in memory at 5,000 ETFs
+    etf_list = []
+    conversion_time = 0
+    for etf_json in generate_etf_universe(size, seed, end_date):
+        start = timer()
+        etf_list.extend(get_etf_list_from_json([etf_json]))
+        conversion_time += timer() - start
+    stages["etfListFromJson"] = conversion_time
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = timer()
+        prices_df = prices.get_complete_prices_data_frame(etf_list)
+        prices_end = timer()
+        dataset = Dataset(etf_list, prices_df)
+        end = timer()
+    stages["pricesDataFrame"] = prices_end - start
+    stages["dataset"] = end - prices_end
+
+    for n, etf_filters in enumerate(BENCHMARK_FILTERS):
+        time_stage(stages, errors, "filtering/{}".format(n),
+                   lambda: optimizer.filter_etfs_using_filters(dataset.etf_index, etf_filters), FILTER_REPEATS)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        etfs = optimizer.filter_etfs_using_filters(dataset.etf_index, {})
+
+    for covariance_model in optimizer.COVARIANCE_MODELS:
+        optimizer.covariance_cache.clear()
+        time_stage(stages, errors, "covariance/{}".format(covariance_model),
+                   lambda: optimizer.get_returns_and_covariance(dataset, etfs, {"covarianceModel": covariance_model}))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        returns, cov, latest_prices = optimizer.get_returns_and_covariance(dataset, etfs, {})
+    volatility = covarianceModels.get_volatility(cov)
+
+    for name in optimizer.OPTIMIZERS:
+        parameters = get_optimizer_parameters(name, returns, volatility)
+        optimized = time_stage(stages, errors, "optimizer/{}".format(name),
+                               lambda: optimizer.get_optimized_weights(returns, cov, parameters))
+
+        if name == optimizer.OPTIMIZER and optimized is not None:
+            weights, performance = optimized
+            time_stage(stages, errors, "discreteAllocation",
+                       lambda: optimizer.get_portfolio_and_performance(weights, performance, latest_prices, parameters,
+                                                                       returns, volatility))
+
+    time_stage(stages, errors, "efficientFrontier",
+               lambda: optimizer.get_efficient_frontier_points(returns, cov, optimizer.N_EF_PLOTTING_POINTS))
+
+    # Backtests need the history of the whole period, so only the ETFs that have it are used
+    starting_date = str(date(end_date.year - BACKTEST_IN_YEARS, end_date.month, 1))
+    backtest_filters = {"minimumDaysWithData": BACKTEST_IN_YEARS * 252}
+    time_stage(stages, errors, "backtest{}Years".format(BACKTEST_IN_YEARS),
+               lambda: backtrader.backtrade(dataset, {}, backtest_filters, {"startingDate": starting_date,
+                                                                            "endingDate": str(end_date)}))
+
+    return {
+        "etfs": size,
+        "days": len(prices_df.index),
+        "pricePoints": int(sum(len(etf.get_dates()) for etf in etf_list)),
+        "stages": stages,
+        "errors": errors
+    }
+
+
+def time_stage(stages, errors, name, function, repeats=1):
+    """ Keeps the fastest of the repeats in stages and returns the result. A stage that fails is kept with no time and
+        its error, so the stages after it still run. The prints of the code being timed are left out of the output."""
+    best = None
+    for _ in range(repeats):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = timer()
+            try:
+                result = function()
+            except Exception as e:
+                stages[name] = None
+                errors[name] = str(e)
+                return None
+            end = timer()
+
+        if best is None or end - start < best:
+            best = end - start
+
+    stages[name] = best
+    return result
+
+
+def get_optimizer_parameters(name, returns, volatility):
+    """ Targets that every universe can reach, the median volatility and return of its ETFs."""
+    parameters = {"optimizer": name}
+
+    if name == "EfficientRisk":
+        parameters["targetVolatility"] = float(np.median(volatility))
+    elif name == "EfficientReturn":
+        parameters["targetReturn"] = float(np.median(returns))
+
+    return parameters
+
+
+def generate_etf_universe(size, seed, end_date):
+    """ Yields documents shaped like ETF.to_json() of ETFs that started trading over the last HISTORY_IN_YEARS
+        years."""
+    market = np.random.default_rng(seed).normal(0.0003, 0.01, HISTORY_IN_YEARS * 366)
+
+    for n in range(size):
+        yield generate_etf_json(n, np.random.default_rng([seed, n]), market, end_date)
+
+
+def generate_etf_json(n, rng, market, end_date):
+    """ Prices follow a random walk with a market factor, with the flaws the real ones have: missing days and gaps of
+        weeks without prices, repeated prices, zeros and spikes of a single day."""
+    isin = "XS{:010d}".format(n)
+    data = {
+        "name": "Synthetic ETF {}".format(n),
+        "isin": isin,
+        "ticker": "SYN{}".format(n),
+        "ter": "{:.2f}%".format(rng.uniform(0.05, 0.95)),
+        "domicileCountry": str(rng.choice(DOMICILE_COUNTRIES)),
+        "replicationMethod": str(rng.choice(REPLICATION_METHODS)),
+        "distributionPolicy": str(rng.choice(DISTRIBUTION_POLICIES)),
+        "fundCurrency": str(rng.choice(FUND_CURRENCIES)),
+        "yearReturnPerRiskCUR": float(rng.normal(0.5, 0.5)),
+        "RICs": ["SYN{}.DE".format(n)]
+    }
+
+    last_day = np.datetime64(end_date)
+    years = rng.uniform(1, HISTORY_IN_YEARS)
+    dates = np.arange(last_day - int(years * 365), last_day + 1, dtype="datetime64[D]")
+    dates = dates[np.is_busday(dates)]
+    dates = dates[rng.random(len(dates)) > 0.02]
+
+    if rng.random() < 0.2:
+        gap_start = rng.integers(0, len(dates))
+        dates = np.delete(dates, np.arange(gap_start, min(gap_start + rng.integers(5, 30), len(dates))))
+
+    # Every ETF follows the same market on the same day
+    days = (dates - (last_day - HISTORY_IN_YEARS * 365)).astype(int)
+    returns = rng.uniform(0.3, 1.2) * market[days] + rng.normal(0.0001, rng.uniform(0.002, 0.01), len(dates))
+    closes = rng.uniform(10, 200) * np.cumprod(1 + returns)
+
+    flaws = rng.random(len(closes))
+    closes[flaws < 0.002] = 0
+    closes[(flaws >= 0.002) & (flaws < 0.004)] *= rng.uniform(5, 20)
+    stale = np.flatnonzero((flaws >= 0.004) & (flaws < 0.01))
+    closes[stale[stale > 0]] = closes[stale[stale > 0] - 1]
+
+    historical_data = [{"date": date_string, "close": close}
+                       for date_string, close in zip(dates.astype(str).tolist(), closes.round(4).tolist())]
+
+    return {"_id": isin, "data": data, "historicalData": historical_data}
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_package_versions():
+    versions = {}
+    for package in ["numpy", "pandas", "pypfopt", "cvxpy"]:
+        try:
+            versions[package] = __import__(package).__version__
+        except (ImportError, AttributeError):
+            versions[package] = None
+    return versions
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare_results(base, new):
+    """ Prints the time of every stage in both results and how many times slower the new one is."""
+    print("Base {} ({}), new {} ({})".format(base["commit"], base["createdAt"], new["commit"], new["createdAt"]))
+
+    base_universes = {universe["etfs"]: universe for universe in base["universes"]}
+    for universe in new["universes"]:
+        base_universe = base_universes.get(universe["etfs"])
+        if base_universe is None:
+            continue
+
+        print()
+        print("{} ETFs".format(universe["etfs"]))
+        for stage, seconds in universe["stages"].items():
+            base_seconds = base_universe["stages"].get(stage)
+            if seconds is None:
+                print("    {:<40} {:>10} {:>10}".format(stage, "-" if base_seconds is None else
+                                                        "{:.3f}s".format(base_seconds), "failed"))
+            elif base_seconds is None:
+                print("    {:<40} {:>10} {:>10.3f}s".format(stage, "-", seconds))
+            else:
+                print("    {:<40} {:>10.3f}s {:>10.3f}s {:>8.2f}x".format(stage, base_seconds, seconds,
+                                                                          seconds / max(base_seconds, 1e-9)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+from ETF import get_etf_list_from_json
+import benchmark
+import optimizer
+import covarianceModels
+import prices
+import contextlib
+import io
+import numpy as np
+import pandas
+from pypfopt import expected_returns
+import sys
+from timeit import default_timer as timer
+
+BENCHMARK_SIZES = [400, 1000, 2000]
+BENCHMARK_DAYS = 2500
+BENCHMARK_OPTIMIZER = "MaxSharpe"
+
+# Beyond this size the dense covariance models take minutes to solve, so they're left out of the benchmark
+DENSE_MAX_SIZE = 1000
+
+
+def main():
+    """ Times every covariance model on synthetic prices of the given numbers of ETFs, by default the ones in
+        BENCHMARK_SIZES. Usage: python benchmarkCovariance.py [size ...]"""
+    sizes = BENCHMARK_SIZES
+    if len(sys.argv) > 1:
+        sizes = [int(size) for size in sys.argv[1:]]
+
+    results = []
+    for size in sizes:
+        prices = get_synthetic_prices(size, BENCHMARK_DAYS)
+
+        for covariance_model in optimizer.COVARIANCE_MODELS:
+            if covariance_model != "factor" and size > DENSE_MAX_SIZE:
+                continue
+
+            results.append(benchmark_covariance_model(prices, covariance_model))
+
+    print()
+    print(pandas.DataFrame(results).to_string(index=False))
+
+
+def benchmark_covariance_model(prices, covariance_model):
+    parameters = {"optimizer": BENCHMARK_OPTIMIZER, "covarianceModel": covariance_model}
+    returns = expected_returns.mean_historical_return(prices)
+
+    start = timer()
+    cov = optimizer.get_covariance(prices, covariance_model, optimizer.N_FACTORS)
+    covariance_end = timer()
+    weights, performance = optimizer.get_optimized_weights(returns, cov, parameters)
+    end = timer()
+
+    return {
+        "ETFs": len(prices.columns),
+        "covarianceModel": covariance_model,
+        "covarianceTime": covariance_end - start,
+        "solveTime": end - covariance_end,
+        "ETFsInPortfolio": sum(1 for weight in weights.values() if weight != 0),
+        "expectedReturn": performance[0],
+        "annualVolatility": performance[1],
+        "sharpeRatio": performance[2],
+        "conditionNumber": get_condition_number(cov)
+    }
+
+
+def get_synthetic_prices(n_etfs, n_days):
+    """ The last n_days of the cleaned prices of the synthetic universe benchmark.py runs on."""
+    etf_list = []
+    for etf_json in benchmark.generate_etf_universe(n_etfs, benchmark.BENCHMARK_SEED, benchmark.BENCHMARK_END_DATE):
+        etf_list.extend(get_etf_list_from_json([etf_json]))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        prices_df = prices.get_complete_prices_data_frame(etf_list)
+
+    return prices_df.iloc[-n_days:]
+
+
+def get_condition_number(cov):
+    if isinstance(cov, covarianceModels.FactorCovariance):
+        cov = cov.to_data_frame()
+
+    eigenvalues = np.linalg.eigvalsh(cov.to_numpy())
+    return float(eigenvalues[-1] / max(eigenvalues[0], 1e-18))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class LRUCache:
+    """ Thread-safe least recently used cache, bounded by the total size in bytes of the values it holds. Entries can
+        also expire a fixed time after they were added."""
+
+    def __init__(self, max_bytes, ttl_in_seconds=None):
+        self.max_bytes = max_bytes
+        self.ttl_in_seconds = ttl_in_seconds
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.size_in_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.coalesced = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self.get_entry(key)
+
+    def get_entry(self, key):
+        """ Must be called holding the lock."""
+        if key not in self.entries:
+            self.misses += 1
+            return None
+
+        value, size_in_bytes, expires_at = self.entries[key]
+        if expires_at is not None and time.monotonic() > expires_at:
+            del self.entries[key]
+            self.size_in_bytes -= size_in_bytes
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, size_in_bytes):
+        with self.lock:
+            if size_in_bytes > self.max_bytes:
+                return
+
+            if key in self.entries:
+                self.size_in_bytes -= self.entries.pop(key)[1]
+
+            expires_at = None
+            if self.ttl_in_seconds is not None:
+                expires_at = time.monotonic() + self.ttl_in_seconds
+
+            self.entries[key] = (value, size_in_bytes, expires_at)
+            self.size_in_bytes += size_in_bytes
+
+            while self.size_in_bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self.entries.popitem(last=False)
+                self.size_in_bytes -= evicted_size
+                self.evictions += 1
+
+    def remove(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.size_in_bytes -= self.entries.pop(key)[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size_in_bytes = 0
+
+    def get_or_compute(self, key, compute, get_size_in_bytes):
+        """ Returns the cached value or computes and caches it. Concurrent calls with the same key wait for the one
+            that's computing it instead of computing it again, and get its exception if it fails."""
+        with self.lock:
+            value = self.get_entry(key)
+            if value is not None:
+                return value
+
+            in_flight = self.in_flight.get(key)
+            if in_flight is not None:
+                self.coalesced += 1
+            else:
+                future = Future()
+                self.in_flight[key] = future
+
+        if in_flight is not None:
+            return in_flight.result()
+
+        try:
+            value = compute()
+            self.put(key, value, get_size_in_bytes(value))
+            future.set_result(value)
+            return value
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "sizeInBytes": self.size_in_bytes,
+                "maxBytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "coalesced": self.coalesced
+            }
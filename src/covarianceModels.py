@@ -0,0 +1,128 @@
+import numpy as np
+import pandas
+
+FREQUENCY = 252
+
+
+class FactorCovariance:
+    """ Annualised covariance of a factor model, loadings @ loadings.T plus a diagonal of residual variances. It's kept
+        in that form, so the variance of a portfolio costs a number of operations proportional to the number of ETFs
+        times the number of factors instead of to the square of the number of ETFs."""
+
+    def __init__(self, index, loadings, residual_variances):
+        self.index = pandas.Index(index)
+        self.loadings = loadings
+        self.residual_variances = residual_variances
+
+    def select(self, identifiers):
+        rows = self.index.get_indexer(identifiers)
+        if (rows < 0).any():
+            raise Exception("The factor covariance doesn't have all the ETFs requested.")
+
+        return FactorCovariance(identifiers, self.loadings[rows], self.residual_variances[rows])
+
+    def get_variances(self):
+        return pandas.Series(np.sum(self.loadings ** 2, axis=1) + self.residual_variances, index=self.index)
+
+    def get_portfolio_variance(self, weights):
+        exposures = self.loadings.T @ weights
+        return float(exposures @ exposures + weights @ (self.residual_variances * weights))
+
+    def get_variance_expression(self, weights):
+        """ The variance of the cvxpy weights as the sum of the squared factor exposures and residuals, which solvers
+            take as a second order cone without ever building the dense matrix."""
+        import cvxpy as cp
+
+        return cp.sum_squares(self.loadings.T @ weights) + \
+            cp.sum_squares(cp.multiply(np.sqrt(self.residual_variances), weights))
+
+    def get_size_in_bytes(self):
+        return self.loadings.nbytes + self.residual_variances.nbytes
+
+    def to_data_frame(self):
+        cov = self.loadings @ self.loadings.T + np.diag(self.residual_variances)
+        return pandas.DataFrame(cov, index=self.index, columns=self.index)
+
+
+def get_ledoit_wolf_covariance(prices):
+    """ Annualised covariance shrunk towards a multiple of the identity, with the shrinkage that minimises the expected
+        error as estimated by Ledoit and Wolf. It's what pypfopt's CovarianceShrinkage.ledoit_wolf computes, without
+        needing scikit-learn. It's better conditioned than the sample covariance when there are many ETFs for the
+        number of days."""
+    returns = get_centered_returns(prices, ddof=0)
+    n_days, n_etfs = returns.shape
+
+    squared_returns = returns ** 2
+    sample_cov = returns.T @ returns / n_days
+    variances = np.sum(squared_returns, axis=0) / n_days
+    mu = np.sum(variances) / n_etfs
+
+    beta = np.sum(squared_returns.T @ squared_returns) / n_days - np.sum(sample_cov ** 2)
+    beta /= n_etfs * n_days
+    delta = (np.sum(sample_cov ** 2) - 2 * mu * np.sum(variances) + n_etfs * mu ** 2) / n_etfs
+
+    beta = min(beta, delta)
+    shrinkage = 0 if beta == 0 else beta / delta
+
+    cov = (1 - shrinkage) * sample_cov
+    cov.flat[::n_etfs + 1] += shrinkage * mu
+
+    return pandas.DataFrame(cov * FREQUENCY, index=prices.columns, columns=prices.columns)
+
+
+def get_factor_covariance(prices, n_factors):
+    """ Principal component factor model of the daily returns, the n_factors largest components of the sample
+        covariance plus the variance each ETF has left, as a FactorCovariance."""
+    returns = get_centered_returns(prices, ddof=1)
+    n_days, n_etfs = returns.shape
+    n_factors = max(1, min(n_factors, n_etfs - 1))
+
+    sample_cov = returns.T @ returns / max(n_days - 1, 1)
+
+    if n_factors >= n_etfs // 2:
+        eigenvalues, eigenvectors = np.linalg.eigh(sample_cov)
+        eigenvalues, eigenvectors = eigenvalues[-n_factors:], eigenvectors[:, -n_factors:]
+    else:
+        from scipy.sparse.linalg import eigsh
+        eigenvalues, eigenvectors = eigsh(sample_cov, k=n_factors, which="LA", v0=np.ones(n_etfs))
+
+    loadings = eigenvectors * np.sqrt(np.maximum(eigenvalues, 0))
+    residual_variances = np.maximum(np.diag(sample_cov) - np.sum(loadings ** 2, axis=1), 0)
+
+    return FactorCovariance(prices.columns, loadings * np.sqrt(FREQUENCY), residual_variances * FREQUENCY)
+
+
+def get_centered_returns(prices, ddof):
+    """ Daily returns centered on the mean of the days each ETF has one, with 0 on the days it doesn't. The returns of
+        every ETF are scaled by sqrt((days - ddof) / (days it has a return - ddof)), so dividing their products by the
+        number of days gives ETFs with a shorter history their own variance instead of one shrunk towards 0. Their
+        correlations are computed over the days both have a return, and the matrix stays positive semidefinite."""
+    prices = prices.to_numpy(dtype=np.float64)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        returns = prices[1:] / prices[:-1] - 1
+
+    returns[~np.isfinite(returns)] = np.nan
+    returns = returns[~np.isnan(returns).all(axis=1)]
+
+    present = ~np.isnan(returns)
+    counts = present.sum(axis=0)
+    means = np.nansum(returns, axis=0) / np.maximum(counts, 1)
+    centered = np.where(present, returns - means, 0.0)
+
+    scale = np.sqrt(max(len(returns) - ddof, 1) / np.maximum(counts - ddof, 1))
+    return centered * scale
+
+
+def get_volatility(cov):
+    if isinstance(cov, FactorCovariance):
+        return np.sqrt(cov.get_variances())
+
+    return pandas.Series(np.sqrt(np.diag(cov)), index=cov.index)
+
+
+def get_size_in_bytes(cov):
+    if isinstance(cov, FactorCovariance):
+        return cov.get_size_in_bytes()
+
+    return int(cov.memory_usage().sum())
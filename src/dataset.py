@@ -0,0 +1,98 @@
+from mongoDB import PRODUCTION_DB_NAME, check_connection
+from etfIndex import ETFIndex
+import parameters
+import prices
+import hashlib
+import threading
+
+
+class Dataset:
+    """ Everything a request reads from. Datasets are never modified, updates build a new one and swap it in, so a
+        request that got the dataset once keeps a consistent view until it finishes. The snapshot path is the one of a
+        prices snapshot with the same data, if any, other processes can load the dataset from it."""
+
+    def __init__(self, etf_list, prices_df, snapshot_path=None):
+        self.etf_list = etf_list
+        self.prices_df = prices_df
+        self.snapshot_path = snapshot_path
+        self.etf_index = ETFIndex(etf_list)
+        self.ters = prices.get_ters(etf_list, prices_df.columns)
+        self.parameters = parameters.get_parameters(etf_list)
+        self.version = get_dataset_version(etf_list, prices_df)
+
+
+_dataset = None
+_update_lock = threading.Lock()
+
+
+def get_dataset():
+    return _dataset
+
+
+def set_dataset(dataset):
+    global _dataset
+    _dataset = dataset
+
+
+def load_dataset():
+    """ Serves the prices snapshot as it is when there is one, so the server is ready without waiting for MongoDB. The
+        prices added to MongoDB since it was written are appended afterwards in the background, like an update. Without
+        a snapshot the prices are loaded from MongoDB and the snapshot is written for the next start."""
+    with _update_lock:
+        if prices.prices_snapshot_exists(prices.PRICES_SNAPSHOT_PATH):
+            etf_list, prices_df = prices.load_prices_snapshot(prices.PRICES_SNAPSHOT_PATH)
+            set_dataset(Dataset(etf_list, prices_df, prices.PRICES_SNAPSHOT_PATH))
+            threading.Thread(target=catch_up_with_mongodb, name="catchUpWithMongoDB", daemon=True).start()
+            return _dataset
+
+        etf_list, prices_df = prices.load_prices_data_frame(PRODUCTION_DB_NAME)
+        snapshot_path = prices.PRICES_SNAPSHOT_PATH if save_snapshot(etf_list, prices_df) else None
+        set_dataset(Dataset(etf_list, prices_df, snapshot_path))
+        return _dataset
+
+
+def catch_up_with_mongodb():
+    """ A restart after an update doesn't go back to the older prices of the snapshot. If MongoDB can't be reached the
+        snapshot keeps being served as it is."""
+    try:
+        check_connection()
+        current, updated_etfs = update_dataset()
+        print("Caught up with MongoDB, {} ETFs updated".format(updated_etfs))
+    except Exception as e:
+        print("Exception catching up with MongoDB, the prices snapshot is served as it is: ", e)
+
+
+def update_dataset():
+    """ Appends the prices added to MongoDB since the dataset was loaded, swaps the new dataset in and writes it to the
+        prices snapshot the next start loads."""
+    with _update_lock:
+        dataset = get_dataset()
+        etf_list, prices_df, updated_etfs = prices.append_historical_data(dataset.etf_list, dataset.prices_df,
+                                                                          PRODUCTION_DB_NAME)
+        if updated_etfs > 0:
+            snapshot_path = prices.PRICES_SNAPSHOT_PATH if save_snapshot(etf_list, prices_df) else None
+            set_dataset(Dataset(etf_list, prices_df, snapshot_path))
+
+        return get_dataset(), updated_etfs
+
+
+def save_snapshot(etf_list, prices_df):
+    """ A snapshot that can't be written only makes the next start slower, the dataset is still served. Returns whether
+        it was written."""
+    try:
+        prices.save_prices_snapshot(etf_list, prices_df, prices.PRICES_SNAPSHOT_PATH)
+        return True
+    except Exception as e:
+        print("Exception saving the prices snapshot: ", e)
+        return False
+
+
+def get_dataset_version(etf_list, prices_df):
+    """ Identifies the data the responses are computed from, the same data gives the same version in every process."""
+    version = hashlib.sha1()
+    version.update(str(prices_df.shape).encode())
+    if len(prices_df.index) > 0:
+        version.update(str(prices_df.index[-1]).encode())
+    version.update("\n".join(prices_df.columns).encode())
+    version.update(str(sum(etf.get_days_with_data() for etf in etf_list)).encode())
+    return version.hexdigest()[:16]
@@ -0,0 +1,54 @@
+import flask
+import gzip
+import hashlib
+import json
+import threading
+
+
+class EncodedResponse:
+    """ A JSON response serialized and gzip-compressed once, then served as is. Its ETag is a hash of its content, so
+        clients that send it back in If-None-Match get a 304 without a body."""
+
+    def __init__(self, body):
+        self.encoded = json.dumps(body, separators=(",", ":")).encode()
+        self.gzipped = gzip.compress(self.encoded)
+        self.etag = hashlib.sha1(self.encoded).hexdigest()
+
+    def to_response(self, request):
+        if "gzip" in request.accept_encodings:
+            response = flask.Response(self.gzipped, mimetype="application/json")
+            response.headers["Content-Encoding"] = "gzip"
+            response.set_etag(self.etag + "-gzip")
+        else:
+            response = flask.Response(self.encoded, mimetype="application/json")
+            response.set_etag(self.etag)
+
+        response.headers["Vary"] = "Accept-Encoding"
+        response.headers["Cache-Control"] = "no-cache"
+        return response.make_conditional(request)
+
+
+class EncodedResponseCache:
+    """ Keeps the encoded response of every endpoint for the dataset version it was built from. A response is built
+        once per version, requests to the same endpoint that arrive while it's being built wait for it. Every endpoint
+        has its own lock, so building a large response doesn't hold up the other endpoints."""
+
+    def __init__(self):
+        self.responses = {}
+        self.endpoint_locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, name, version, build_body):
+        cached = self.responses.get(name)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        with self.lock:
+            endpoint_lock = self.endpoint_locks.setdefault(name, threading.Lock())
+
+        with endpoint_lock:
+            cached = self.responses.get(name)
+            if cached is None or cached[0] != version:
+                cached = (version, EncodedResponse(build_body()))
+                self.responses[name] = cached
+            return cached[1]
@@ -0,0 +1,66 @@
+import numpy as np
+
+
+class ETFIndex:
+    """ Lookups for the ETF filters, built once per dataset. Every attribute value maps to a boolean mask over the ETF
+        list, so applying a set of filters is a few vectorized ANDs instead of a scan over the ETFs."""
+
+    def __init__(self, etf_list):
+        self.etf_list = etf_list
+        self.days_with_data = np.array([etf.get_days_with_data() for etf in etf_list], dtype=np.int64)
+
+        self.positions_by_isin = {}
+        for position, etf in enumerate(etf_list):
+            self.positions_by_isin.setdefault(etf.get_isin(), []).append(position)
+
+        self.domicile_countries = get_masks_by_value(etf_list, lambda etf: etf.get_domicile_country())
+        self.replication_methods = get_masks_by_value(etf_list, lambda etf: etf.get_replication_method())
+        self.distribution_policies = get_masks_by_value(etf_list, lambda etf: etf.get_distribution_policy())
+        self.fund_currencies = get_masks_by_value(etf_list, lambda etf: etf.get_fund_currency())
+
+    def with_minimum_days_with_data(self, minimum_days_with_data):
+        return self.days_with_data >= minimum_days_with_data
+
+    def with_isins(self, isin_list):
+        positions = []
+        for isin in isin_list:
+            positions.extend(self.positions_by_isin.get(isin, []))
+
+        mask = np.zeros(len(self.etf_list), dtype=bool)
+        mask[positions] = True
+        return mask
+
+    def with_domicile_country(self, domicile_country):
+        return self.get_mask(self.domicile_countries, domicile_country)
+
+    def with_replication_method(self, replication_method):
+        return self.get_mask(self.replication_methods, replication_method)
+
+    def with_distribution_policy(self, distribution_policy):
+        return self.get_mask(self.distribution_policies, distribution_policy)
+
+    def with_fund_currency(self, fund_currency):
+        return self.get_mask(self.fund_currencies, fund_currency)
+
+    def get_mask(self, masks_by_value, value):
+        if value in masks_by_value:
+            return masks_by_value[value]
+        return np.zeros(len(self.etf_list), dtype=bool)
+
+    def get_etfs(self, mask):
+        return [self.etf_list[position] for position in np.flatnonzero(mask)]
+
+
+def get_masks_by_value(etf_list, get_value):
+    positions_by_value = {}
+    for position, etf in enumerate(etf_list):
+        positions_by_value.setdefault(get_value(etf), []).append(position)
+
+    masks_by_value = {}
+    for value, positions in positions_by_value.items():
+        mask = np.zeros(len(etf_list), dtype=bool)
+        mask[positions] = True
+        mask.setflags(write=False)
+        masks_by_value[value] = mask
+
+    return masks_by_value
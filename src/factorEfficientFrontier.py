@@ -0,0 +1,78 @@
+import cvxpy as cp
+import numpy as np
+from collections import OrderedDict
+from frontier import FRONTIER_SOLVER
+
+
+class FactorEfficientFrontier:
+    """ The long-only optimizers of pypfopt's EfficientFrontier, with the same methods, for a FactorCovariance. pypfopt
+        only takes a dense covariance matrix, which makes the problem grow with the square of the number of ETFs, while
+        the variance of the factor model grows with the number of ETFs times the number of factors."""
+
+    def __init__(self, expected_returns, cov):
+        self.tickers = list(expected_returns.index)
+        self.expected_returns = expected_returns.to_numpy(dtype=np.float64)
+        self.cov = cov.select(expected_returns.index)
+        self.weights = None
+
+    def min_volatility(self):
+        weights = cp.Variable(len(self.tickers))
+        self.solve(cp.Minimize(self.cov.get_variance_expression(weights)), self.get_constraints(weights), weights)
+
+    def efficient_return(self, target_return):
+        if target_return > self.expected_returns.max():
+            raise ValueError("target_return must be lower than the maximum possible return")
+
+        weights = cp.Variable(len(self.tickers))
+        constraints = self.get_constraints(weights) + [self.expected_returns @ weights >= target_return]
+        self.solve(cp.Minimize(self.cov.get_variance_expression(weights)), constraints, weights)
+
+    def efficient_risk(self, target_volatility):
+        weights = cp.Variable(len(self.tickers))
+        constraints = self.get_constraints(weights) + \
+            [self.cov.get_variance_expression(weights) <= target_volatility ** 2]
+        self.solve(cp.Maximize(self.expected_returns @ weights), constraints, weights)
+
+    def max_sharpe(self, risk_free_rate=0.02):
+        """ Same change of variables as pypfopt, the weights are scaled so the excess return is 1 and the variance is
+            minimised, which is convex unlike the Sharpe ratio."""
+        if self.expected_returns.max() <= risk_free_rate:
+            raise ValueError("at least one of the assets must have an expected return exceeding the risk-free rate")
+
+        scaled_weights = cp.Variable(len(self.tickers))
+        scale = cp.Variable()
+        constraints = [(self.expected_returns - risk_free_rate) @ scaled_weights == 1,
+                       cp.sum(scaled_weights) == scale, scale >= 0, scaled_weights >= 0, scaled_weights <= scale]
+        self.solve(cp.Minimize(self.cov.get_variance_expression(scaled_weights)), constraints, scaled_weights)
+
+        self.weights = self.weights / scale.value
+
+    def get_constraints(self, weights):
+        return [cp.sum(weights) == 1, weights >= 0, weights <= 1]
+
+    def solve(self, objective, constraints, weights):
+        problem = cp.Problem(objective, constraints)
+        try:
+            problem.solve(solver=FRONTIER_SOLVER)
+        except cp.SolverError as e:
+            raise Exception("The factor model optimization failed: {}".format(e))
+
+        if problem.status not in (cp.OPTIMAL, cp.OPTIMAL_INACCURATE):
+            raise Exception("The factor model optimization is {}. Check the target of the optimizer."
+                            .format(problem.status))
+
+        self.weights = weights.value
+
+    def clean_weights(self, cutoff=1e-4, rounding=5):
+        weights = self.weights.copy()
+        weights[np.abs(weights) < cutoff] = 0
+        if rounding is not None:
+            weights = np.round(weights, rounding)
+
+        return OrderedDict(zip(self.tickers, weights.tolist()))
+
+    def portfolio_performance(self, risk_free_rate=0.02):
+        expected_return = float(self.expected_returns @ self.weights)
+        volatility = np.sqrt(max(self.cov.get_portfolio_variance(self.weights), 0))
+
+        return expected_return, volatility, (expected_return - risk_free_rate) / volatility
@@ -0,0 +1,191 @@
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import eikon
+import pandas
+import random
+import requests
+import socket
+import threading
+import time
+
+MAX_ROWS_PER_REQUEST = 3000
+# Rate limited, timed out or failed on Eikon's side, the request can succeed if it's sent again
+RETRYABLE_EIKON_ERROR_CODES = {408, 429, 500, 502, 503, 504, 2504}
+
+
+class DataProvider(ABC):
+    """ Source of RICs and daily closes. A request for closes returns at most MAX_ROWS_PER_REQUEST rows, the most
+        recent ones of the range."""
+
+    @abstractmethod
+    def get_rics(self, isins):
+        pass
+
+    @abstractmethod
+    def get_rics_with_data(self, rics):
+        pass
+
+    @abstractmethod
+    def get_closes(self, ric, start_date, end_date):
+        pass
+
+    def is_retryable(self, error):
+        """ Only connections that failed or timed out are retried by default, other errors fail the same way again."""
+        return isinstance(error, (ConnectionError, TimeoutError, socket.timeout, requests.exceptions.ConnectionError,
+                                  requests.exceptions.Timeout))
+
+
+class EikonDataProvider(DataProvider):
+
+    def __init__(self, app_key):
+        eikon.set_app_key(app_key)
+
+    def get_rics(self, isins):
+        ric_codes = eikon.get_symbology(isins, from_symbol_type="ISIN", to_symbol_type="RIC", bestMatch=False)
+
+        rics = []
+        for index, row in ric_codes.iterrows():
+            rics.append(row["RICs"])
+        return rics
+
+    def get_rics_with_data(self, rics):
+        if len(rics) == 0:
+            return []
+
+        result = eikon.get_timeseries(rics, start_date=-datetime.timedelta(days=30), end_date=datetime.datetime.now(),
+                                      fields="CLOSE")
+
+        return list(result)
+
+    def get_closes(self, ric, start_date, end_date):
+        result = eikon.get_timeseries(ric, start_date=start_date, end_date=end_date, fields="CLOSE")
+
+        data = []
+        for index, row in result.iterrows():
+            close = row["CLOSE"]
+            if pandas.isna(close):
+                close = float("nan")
+            data.append({"date": str(index.date()), "close": close})
+
+        return data
+
+    def is_retryable(self, error):
+        if isinstance(error, eikon.EikonError):
+            return error.code in RETRYABLE_EIKON_ERROR_CODES
+        return super().is_retryable(error)
+
+
+class LocalDataProvider(DataProvider):
+    """ Serves closes kept in memory the way Eikon pages them, so the fetching can run without Eikon."""
+
+    def __init__(self, closes_by_ric, rics_by_isin=None):
+        self.closes_by_ric = closes_by_ric
+        self.rics_by_isin = rics_by_isin or {}
+
+    def get_rics(self, isins):
+        return [self.rics_by_isin.get(isin, []) for isin in isins]
+
+    def get_rics_with_data(self, rics):
+        return [ric for ric in rics if len(self.closes_by_ric.get(ric, [])) > 0]
+
+    def get_closes(self, ric, start_date, end_date):
+        start_date = get_date_string(start_date)
+        end_date = get_date_string(end_date)
+
+        closes = [close for close in self.closes_by_ric.get(ric, []) if start_date <= close["date"] <= end_date]
+        return closes[-MAX_ROWS_PER_REQUEST:]
+
+
+class TokenBucket:
+    """ Allows rate requests per second on average, and bursts of up to capacity requests."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class FetchScheduler:
+    """ Runs the requests to a data provider on a fixed number of threads, so there's always the same number of requests
+        in flight, under a rate limit and with exponential backoff retries of the errors the provider says are
+        transient. A call waits for its own request, callers keep the threads busy by calling from as many threads of
+        their own."""
+
+    def __init__(self, provider, concurrent_requests, requests_per_second, max_retries, backoff_in_seconds=1.0):
+        self.provider = provider
+        self.executor = ThreadPoolExecutor(max_workers=concurrent_requests)
+        self.rate_limit = TokenBucket(requests_per_second, concurrent_requests)
+        self.max_retries = max_retries
+        self.backoff_in_seconds = backoff_in_seconds
+
+    def submit(self, function, *args):
+        return self.executor.submit(self.call_with_retries, function, args)
+
+    def call_with_retries(self, function, args):
+        attempt = 0
+        while True:
+            self.rate_limit.acquire()
+            try:
+                return function(*args)
+            except Exception as e:
+                if attempt >= self.max_retries or not self.provider.is_retryable(e):
+                    raise
+
+                delay = self.backoff_in_seconds * (2 ** attempt) * (1 + random.random())
+                print("Request failed, retrying in {:.1f}s: {}".format(delay, e))
+                time.sleep(delay)
+                attempt += 1
+
+    def get_rics(self, isins):
+        return self.submit(self.provider.get_rics, isins).result()
+
+    def get_rics_with_data(self, rics):
+        return self.submit(self.provider.get_rics_with_data, rics).result()
+
+    def get_closes(self, ric, start_date, end_date):
+        """ All closes of the RIC in the range. Pages go backwards from end_date, a request gets the most recent closes
+            before the ones already fetched, until a page isn't full. Most RICs have less than MAX_ROWS_PER_REQUEST
+            days, so they take a single request. Must not be called from the scheduler's own threads."""
+        start_date = get_date_string(start_date)
+
+        closes = []
+        while True:
+            data = self.submit(self.provider.get_closes, ric, start_date, end_date).result()
+            closes = data + closes
+
+            if len(data) < MAX_ROWS_PER_REQUEST or data[0]["date"] <= start_date:
+                return closes
+
+            end_date = get_previous_day(data[0]["date"])
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+def get_date_string(date):
+    if isinstance(date, str):
+        return date
+    return date.strftime("%Y-%m-%d")
+
+
+def get_previous_day(date_string):
+    date = datetime.datetime.strptime(date_string, "%Y-%m-%d") - datetime.timedelta(days=1)
+    return date.strftime('%Y-%m-%d')
@@ -0,0 +1,91 @@
+import cvxpy as cp
+from covarianceModels import FactorCovariance
+import numpy as np
+import pandas
+from timeit import default_timer
+
+# Interior point solvers don't warm start, but only compiling the problem once is what saves most of the time. OSQP
+# warm starts, but it stalls on the points close to the highest return
+if cp.CLARABEL in cp.installed_solvers():
+    FRONTIER_SOLVER = cp.CLARABEL
+else:
+    FRONTIER_SOLVER = cp.ECOS
+
+
+class EfficientFrontierSweep:
+    """ Long-only minimum volatility portfolios for a range of target returns, the points pypfopt's
+        plot_efficient_frontier solves one by one on a copy of the whole problem each. The problem is built once with the
+        target return as a parameter, so cvxpy only compiles it for the first point and reuses it for the others."""
+
+    def __init__(self, returns, cov):
+        self.identifiers = returns.index
+        self.returns = returns.to_numpy(dtype=np.float64)
+
+        self.weights = cp.Variable(len(self.returns))
+        self.target_return = cp.Parameter()
+
+        if isinstance(cov, FactorCovariance):
+            self.cov = cov.select(self.identifiers)
+            variance = self.cov.get_variance_expression(self.weights)
+        else:
+            self.cov = cov.loc[self.identifiers, self.identifiers].to_numpy(dtype=np.float64)
+            variance = cp.quad_form(self.weights, cp.psd_wrap(self.cov))
+
+        constraints = [cp.sum(self.weights) == 1, self.weights >= 0, self.returns @ self.weights >= self.target_return]
+        self.problem = cp.Problem(cp.Minimize(variance), constraints)
+
+    def solve(self, target_return):
+        """ Weights of the portfolio, or None if the target return can't be reached."""
+        self.target_return.value = target_return
+        try:
+            self.problem.solve(solver=FRONTIER_SOLVER, warm_start=True)
+        except cp.SolverError:
+            return None
+
+        if self.problem.status not in (cp.OPTIMAL, cp.OPTIMAL_INACCURATE):
+            return None
+
+        return np.clip(self.weights.value, 0, 1)
+
+    def get_portfolio_variance(self, weights):
+        if isinstance(self.cov, FactorCovariance):
+            return self.cov.get_portfolio_variance(weights)
+
+        return weights @ self.cov @ weights
+
+    def get_default_target_returns(self, points):
+        """ The range pypfopt plots, from the return of the minimum volatility portfolio to just below the highest
+            return of a single ETF."""
+        min_volatility_weights = self.solve(self.returns.min() - 1)
+        if min_volatility_weights is None:
+            raise Exception("Could not find the minimum volatility portfolio of the efficient frontier.")
+
+        return np.linspace(self.returns @ min_volatility_weights, self.returns.max() - 0.0001, points)
+
+    def sweep(self, target_returns):
+        """ Returns a table with the expected return, volatility and solve time of every point of the frontier and a
+            table with their weights. Target returns that can't be reached are left out."""
+        rows = []
+        weights = []
+
+        for target_return in target_returns:
+            start = default_timer()
+            point_weights = self.solve(target_return)
+            end = default_timer()
+
+            if point_weights is None:
+                continue
+
+            rows.append({
+                "targetReturn": float(target_return),
+                "expectedReturn": float(self.returns @ point_weights),
+                "volatility": float(np.sqrt(max(self.get_portfolio_variance(point_weights), 0))),
+                "solveTime": end - start
+            })
+            weights.append(point_weights)
+
+        points = pandas.DataFrame(rows, columns=["targetReturn", "expectedReturn", "volatility", "solveTime"])
+        weights = pandas.DataFrame(np.array(weights).reshape(len(weights), len(self.identifiers)),
+                                   columns=self.identifiers)
+
+        return points, weights
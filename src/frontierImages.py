@@ -0,0 +1,81 @@
+from cache import LRUCache
+import timing
+import hashlib
+import io
+import json
+import os
+
+FRONTIER_IMAGE_CACHE_MAX_BYTES = int(os.environ.get('FRONTIER_IMAGE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+# Plots and their images are stored under the hash of the plot, so the same result always gets the same image id
+plot_cache = LRUCache(FRONTIER_IMAGE_CACHE_MAX_BYTES)
+image_cache = LRUCache(FRONTIER_IMAGE_CACHE_MAX_BYTES)
+
+
+def get_efficient_frontier_plot(frontier_points, volatility, returns, portfolio):
+    """ What's needed to draw the efficient frontier of an optimization."""
+    return {
+        "frontier": [[float(point["volatility"]), float(point["expectedReturn"])] for point in frontier_points],
+        "assets": [[float(volatility[etf]), float(returns[etf])] for etf in returns.index],
+        "assetsInPortfolio": [[float(etf["volatility"]), float(etf["expectedReturn"])] for etf in portfolio["portfolio"]],
+        "portfolio": [float(portfolio["annualVolatility"]), float(portfolio["expectedReturn"])]
+    }
+
+
+def add_efficient_frontier_plot(plot):
+    """ Keeps the plot and returns the id of its image, which is only rendered once it's requested."""
+    encoded = json.dumps(plot, separators=(",", ":")).encode()
+    image_id = hashlib.sha1(encoded).hexdigest()
+    plot_cache.put(image_id, plot, len(encoded))
+
+    return image_id
+
+
+def has_efficient_frontier_plot(image_id):
+    return plot_cache.get(image_id) is not None
+
+
+def get_efficient_frontier_image(image_id):
+    """ PNG of the plot with the given id, or None if the plot isn't known or was evicted."""
+    image = image_cache.get(image_id)
+    if image is not None:
+        return image
+
+    plot = plot_cache.get(image_id)
+    if plot is None:
+        return None
+
+    with timing.span("efficientFrontierImage"):
+        image = render_efficient_frontier_image(plot)
+    image_cache.put(image_id, image, len(image))
+
+    return image
+
+
+def render_efficient_frontier_image(plot):
+    """ Draws on its own figure and canvas instead of pyplot's global state, so images can be rendered concurrently.
+        matplotlib is only imported once the first image is rendered, it takes a while."""
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+
+    ax.plot([point[0] for point in plot["frontier"]], [point[1] for point in plot["frontier"]],
+            label="Efficient frontier")
+    ax.scatter([asset[0] for asset in plot["assets"]], [asset[1] for asset in plot["assets"]], s=30, color="k",
+               label="assets")
+    ax.scatter([asset[0] for asset in plot["assetsInPortfolio"]], [asset[1] for asset in plot["assetsInPortfolio"]],
+               s=30, color="g", label="assets in portfolio")
+    ax.scatter(plot["portfolio"][0], plot["portfolio"][1], marker="*", s=100, c="r", label="Optimized Portfolio")
+
+    ax.set_xlabel("Volatility")
+    ax.set_ylabel("Return")
+    ax.set_title("Efficient Frontier")
+    ax.legend()
+    fig.tight_layout()
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png")
+    return buf.getvalue()
@@ -0,0 +1,118 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import uuid
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class TooManyJobs(Exception):
+    pass
+
+
+class Job:
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = QUEUED
+        self.done_steps = 0
+        self.total_steps = None
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.cancel_requested = threading.Event()
+
+    def report_progress(self, done_steps, total_steps):
+        """ Called by the job after every step, it's also where a cancelled job stops."""
+        if self.cancel_requested.is_set():
+            raise JobCancelled()
+
+        self.done_steps = done_steps
+        self.total_steps = total_steps
+
+    def is_finished(self):
+        return self.status in (DONE, FAILED, CANCELLED)
+
+    def to_json(self):
+        return {
+            "jobId": self.id,
+            "status": self.status,
+            "cancelRequested": self.cancel_requested.is_set(),
+            "progress": {"done": self.done_steps, "total": self.total_steps},
+            "error": self.error,
+            "createdAt": self.created_at,
+            "finishedAt": self.finished_at
+        }
+
+
+class JobRunner:
+    """ Runs long jobs on a bounded pool of worker threads. Submitting fails when too many jobs are waiting or running,
+        and finished jobs are forgotten once their result is older than the TTL."""
+
+    def __init__(self, workers, max_active_jobs, result_ttl_in_seconds):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.max_active_jobs = max_active_jobs
+        self.result_ttl_in_seconds = result_ttl_in_seconds
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, function, *args):
+        """ Runs function(*args, progress_callback=...) in the background and returns its job."""
+        with self.lock:
+            self.evict_expired_jobs()
+
+            active_jobs = sum(1 for job in self.jobs.values() if not job.is_finished())
+            if active_jobs >= self.max_active_jobs:
+                raise TooManyJobs("There are already {} jobs waiting or running, try again later.".format(active_jobs))
+
+            job = Job()
+            self.jobs[job.id] = job
+
+        self.executor.submit(self.run, job, function, args)
+        return job
+
+    def run(self, job, function, args):
+        if job.cancel_requested.is_set():
+            self.finish(job, CANCELLED)
+            return
+
+        job.status = RUNNING
+        try:
+            job.result = function(*args, progress_callback=job.report_progress)
+            self.finish(job, DONE)
+        except JobCancelled:
+            self.finish(job, CANCELLED)
+        except Exception as e:
+            print("Exception in job {}: ".format(job.id), e)
+            job.error = str(e)
+            self.finish(job, FAILED)
+
+    def finish(self, job, status):
+        job.finished_at = time.time()
+        job.status = status
+
+    def get(self, job_id):
+        with self.lock:
+            self.evict_expired_jobs()
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is not None and not job.is_finished():
+            job.cancel_requested.set()
+        return job
+
+    def evict_expired_jobs(self):
+        now = time.time()
+        for job_id in [job_id for job_id, job in self.jobs.items()
+                       if job.is_finished() and now - job.finished_at > self.result_ttl_in_seconds]:
+            del self.jobs[job_id]
@@ -0,0 +1,46 @@
+from mongoDB import get_mongo_client, get_prices_collection, get_price_documents, get_history_summary, TEST_DB_NAME
+from timeit import default_timer as timer
+import sys
+
+
+def main():
+    db_name = TEST_DB_NAME
+    if len(sys.argv) > 1:
+        db_name = sys.argv[1]
+
+    migrate_prices(db_name)
+
+
+def migrate_prices(db_name):
+    """ Moves the historicalData array of every ETF document to the prices collection. The array is only removed once
+        the prices of its ETF are written, so the migration can be run again after a failure."""
+    print()
+    print("Migrate prices of the {} database".format(db_name))
+
+    start = timer()
+    db = get_mongo_client()[db_name]
+    prices = get_prices_collection(db)
+
+    migrated = 0
+    days_migrated = 0
+    for etf in db.etfs.find({"historicalData": {"$exists": True}}, {"data.isin": 1, "historicalData": 1}):
+        isin = etf["data"]["isin"]
+        historical_data = etf["historicalData"]
+
+        # Prices left by a previous run that failed before removing the array are written again
+        prices.delete_many({"isin": isin})
+        if len(historical_data) > 0:
+            prices.insert_many(get_price_documents(isin, historical_data), ordered=False)
+
+        db.etfs.update_one({"_id": etf["_id"]}, {"$set": get_history_summary(historical_data),
+                                                 "$unset": {"historicalData": ""}})
+
+        migrated += 1
+        days_migrated += len(historical_data)
+
+    end = timer()
+    print("Took {}s to migrate {} days of data of {} ETFs".format(end - start, days_migrated, migrated))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,57 +1,291 @@
 from ETF import get_etf_list_from_json
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 from timeit import default_timer
+import timing
+import datetime
+import numpy as np
 import os
+import threading
 
 MONGO_DB_HOST = os.environ.get('MONGO_DB_HOST')
 MONGO_DB_PORT = int(os.environ.get('MONGO_DB_PORT', 2717))
+MONGO_BULK_WRITE_SIZE = int(os.environ.get('MONGO_BULK_WRITE_SIZE', 100))
+# Every document of the prices stream holds the whole history of one ISIN
+PRICES_STREAM_BATCH_SIZE = int(os.environ.get('PRICES_STREAM_BATCH_SIZE', 50))
+# How long the optimizer waits for MongoDB before it keeps serving its prices snapshot without the newer prices
+MONGO_CHECK_TIMEOUT_MS = int(os.environ.get('MONGO_CHECK_TIMEOUT_MS', 2000))
 
 TEST_DB_NAME = "test"
 PRODUCTION_DB_NAME = "prod"
 
+# Daily closes live in a time-series collection, one document per ISIN and day, next to the ETF metadata in etfs.
+# Deleting from a time-series collection needs MongoDB 5.1 or later, the image is pinned in docker-compose.yml
+# and kubernetes/mongo-db-deployment-and-service.yml
+PRICES_COLLECTION = "prices"
+
+_client = None
+_client_lock = threading.Lock()
+
 
 def get_mongo_client():
+    """ MongoClient is thread-safe and keeps its own connection pool, so the whole process shares a single one."""
+    global _client
+
+    with _client_lock:
+        if _client is None:
+            _client = create_mongo_client()
+        return _client
+
+
+def create_mongo_client(**options):
     if MONGO_DB_HOST is not None:
-        return MongoClient(host=MONGO_DB_HOST, port=MONGO_DB_PORT)
-    else:
-        return MongoClient("mongodb://mongo-service:2717")
+        return MongoClient(host=MONGO_DB_HOST, port=MONGO_DB_PORT, **options)
+    return MongoClient("mongodb://mongo-service:2717", **options)
+
+
+def check_connection(timeout_ms=MONGO_CHECK_TIMEOUT_MS):
+    """ Raises if MongoDB doesn't answer within the timeout, instead of waiting for the server selection timeout of the
+        shared client."""
+    client = create_mongo_client(serverSelectionTimeoutMS=timeout_ms)
+    try:
+        client.admin.command("ping")
+    finally:
+        client.close()
+
+
+class BulkWriter:
+    """ Buffers updates to the ETFs and sends them as unordered bulk writes of flush_size operations, instead of one
+        round trip per ETF. Use it as a context manager so the last operations are flushed."""
+
+    def __init__(self, db_name, flush_size=MONGO_BULK_WRITE_SIZE):
+        db = get_mongo_client()[db_name]
+        self.etfs = db.etfs
+        self.prices = get_prices_collection(db)
+        self.flush_size = flush_size
+        # Every operation is the update of the ETF document, the ISIN whose prices it replaces and the new prices
+        self.operations = []
+        self.written = 0
+        self.time_writing = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+        if self.written > 0:
+            print("Wrote {} ETFs to MongoDB in {}s, {:.1f} ETFs/s".format(self.written, self.time_writing,
+                                                                           self.written / self.time_writing))
+
+    def update_etf_historical_data(self, etf):
+        historical_data = etf.get_historical_data()
+        self.add((UpdateOne({'_id': etf.get_id()}, get_history_update(etf, historical_data)), etf.get_isin(),
+                  get_price_documents(etf.get_isin(), historical_data)))
+
+    def append_etf_historical_data(self, etf, new_historical_data):
+        self.add((UpdateOne({'_id': etf.get_id()}, get_append_update(new_historical_data)), None,
+                  get_price_documents(etf.get_isin(), new_historical_data)))
+
+    def add(self, operation):
+        with self.lock:
+            self.operations.append(operation)
+            if len(self.operations) < self.flush_size:
+                return
+            operations = self.operations
+            self.operations = []
+
+        self.write(operations)
+
+    def flush(self):
+        with self.lock:
+            operations = self.operations
+            self.operations = []
+
+        if len(operations) > 0:
+            self.write(operations)
+
+    def write(self, operations):
+        start = default_timer()
+
+        # Prices are written before the ETF documents that count them
+        replaced_isins = [isin for _, isin, _ in operations if isin is not None]
+        if len(replaced_isins) > 0:
+            self.prices.delete_many({"isin": {"$in": replaced_isins}})
+
+        price_documents = [document for _, _, documents in operations for document in documents]
+        if len(price_documents) > 0:
+            self.prices.insert_many(price_documents, ordered=False)
+
+        self.etfs.bulk_write([etf_update for etf_update, _, _ in operations], ordered=False)
+
+        end = default_timer()
+
+        with self.lock:
+            self.written += len(operations)
+            self.time_writing += end - start
+
+        print("Took {}s to write {} ETFs to MongoDB, {:.1f} ETFs/s".format(end - start, len(operations),
+                                                                          len(operations) / (end - start)))
+
+
+def get_prices_collection(db):
+    """ Creates the prices time-series collection and its (isin, date) index the first time it's used."""
+    if PRICES_COLLECTION not in db.list_collection_names():
+        db.create_collection(PRICES_COLLECTION, timeseries={"timeField": "date", "metaField": "isin",
+                                                            "granularity": "hours"})
+        db[PRICES_COLLECTION].create_index([("isin", 1), ("date", 1)])
+
+    return db[PRICES_COLLECTION]
 
 
 def get_etf_list(db_name):
+    """ Only the ETF metadata, the historical data of the ETFs is left empty."""
     print("Getting ETFs from MongoDB")
-    start = default_timer()
-    db = get_mongo_client()[db_name]
-    etfs = db.etfs.find(allow_disk_use=True).sort("data.yearReturnPerRiskCUR", -1)
-    etf_list = get_etf_list_from_json(etfs)
-    end = default_timer()
-    print("Time to get etfList from mongoDB " + str(end - start))
+    with timing.span("getETFList") as etf_list_span:
+        db = get_mongo_client()[db_name]
+        etfs = db.etfs.find({}, {"historicalData": 0}, allow_disk_use=True).sort("data.yearReturnPerRiskCUR", -1)
+        etf_list = get_etf_list_from_json(etfs)
+    print("Time to get etfList from mongoDB " + str(etf_list_span.seconds))
     return etf_list
 
 
-def get_etf_list_with_historical_data(db_name):
-    etf_list = get_etf_list(db_name)
-    etf_list_with_data = []
+def get_etf_list_with_data(db_name):
+    """ Metadata of the ETFs that have historical data, filtered and projected by MongoDB."""
+    with timing.span("getETFListWithData") as etf_list_span:
+        db = get_mongo_client()[db_name]
+        etfs = db.etfs.find({"daysWithData": {"$gt": 0}}, {"data": 1, "daysWithData": 1, "lastDate": 1},
+                            allow_disk_use=True).sort("data.yearReturnPerRiskCUR", -1)
+        etf_list = get_etf_list_from_json(etfs)
+    print("Time to get etfList with data from mongoDB " + str(etf_list_span.seconds))
+    return etf_list
 
-    for etf in etf_list:
-        if len(etf.get_historical_data()) > 0:
-            etf_list_with_data.append(etf)
 
-    return etf_list_with_data
+def stream_prices(db_name, start_date=None, end_date=None):
+    """ Yields the ISIN, dates and closes of every ETF as numpy arrays sorted by date, one ETF at a time. MongoDB groups
+        the prices of each ISIN into arrays, so there's no Python object per day and only one batch is held at once."""
+    db = get_mongo_client()[db_name]
+
+    pipeline = []
+    date_range_query = get_date_range_query(start_date, end_date)
+    if len(date_range_query) > 0:
+        pipeline.append({"$match": date_range_query})
+    pipeline.append({"$sort": {"isin": 1, "date": 1}})
+    pipeline.append({"$group": {"_id": "$isin", "dates": {"$push": "$date"}, "closes": {"$push": "$close"}}})
+
+    documents = get_prices_collection(db).aggregate(pipeline, allowDiskUse=True, batchSize=PRICES_STREAM_BATCH_SIZE)
+    for document in documents:
+        dates = np.array(document["dates"], dtype="datetime64[ms]").astype("datetime64[D]")
+        closes = np.array(document["closes"], dtype=np.float64)
+        yield document["_id"], dates, closes
 
 
 def save_etf_list(etf_list, db_name):
     json_data = []
+    price_documents = []
 
     for etf in etf_list:
-        json_data.append(etf.to_json())
+        etf_as_json = {"data": etf.get_data()}
+        etf_as_json.update(get_history_summary(etf.get_historical_data()))
+        json_data.append(etf_as_json)
+        price_documents += get_price_documents(etf.get_isin(), etf.get_historical_data())
 
     db = get_mongo_client()[db_name]
+    if len(price_documents) > 0:
+        get_prices_collection(db).insert_many(price_documents, ordered=False)
     db.etfs.insert_many(json_data)
 
 
 def update_etf_historical_data(etf, db_name):
     db = get_mongo_client()[db_name]
-    db.etfs.update_one({'_id': etf.get_id()}, {'$set': {'historicalData': etf.get_historical_data()}})
+    prices = get_prices_collection(db)
+    historical_data = etf.get_historical_data()
+
+    prices.delete_many({"isin": etf.get_isin()})
+    if len(historical_data) > 0:
+        prices.insert_many(get_price_documents(etf.get_isin(), historical_data), ordered=False)
+    db.etfs.update_one({'_id': etf.get_id()}, get_history_update(etf, historical_data))
+
+
+def append_etf_historical_data(etf, new_historical_data, db_name):
+    """ Only inserts the new days, the prices already stored aren't touched."""
+    if len(new_historical_data) == 0:
+        return
+
+    db = get_mongo_client()[db_name]
+    get_prices_collection(db).insert_many(get_price_documents(etf.get_isin(), new_historical_data), ordered=False)
+    db.etfs.update_one({'_id': etf.get_id()}, get_append_update(new_historical_data))
+
+
+def get_etf_historical_data_tails(db_name, start_date):
+    """ Returns the dates and closes since start_date as numpy arrays and the total number of days with data of every
+        ETF, by ISIN. The closes are streamed with stream_prices, so no Python object is kept per day."""
+    with timing.span("getHistoricalDataTails"):
+        db = get_mongo_client()[db_name]
+
+        tails = {}
+        for etf in db.etfs.find({}, {"data.isin": 1, "daysWithData": 1}):
+            tails[etf["data"]["isin"]] = {"daysWithData": etf.get("daysWithData", 0),
+                                          "dates": np.array([], dtype="datetime64[D]"),
+                                          "closes": np.array([], dtype=np.float64)}
+
+        for isin, dates, closes in stream_prices(db_name, start_date):
+            if isin in tails:
+                tails[isin]["dates"] = dates
+                tails[isin]["closes"] = closes
+
+        return tails
+
+
+def get_etf_historical_data(isin, db_name, start_date=None, end_date=None):
+    """ Historical data of one ETF, optionally only the days between start_date and end_date, both included."""
+    db = get_mongo_client()[db_name]
+    query = {"isin": isin}
+    query.update(get_date_range_query(start_date, end_date))
+
+    documents = get_prices_collection(db).find(query, {"_id": 0, "date": 1, "close": 1}).sort("date", 1)
+    return [get_date_price(document) for document in documents]
+
+
+def get_date_range_query(start_date, end_date):
+    date_range = {}
+    if start_date is not None:
+        date_range["$gte"] = datetime.datetime.strptime(start_date, "%Y-%m-%d")
+    if end_date is not None:
+        date_range["$lte"] = datetime.datetime.strptime(end_date, "%Y-%m-%d")
+
+    if len(date_range) == 0:
+        return {}
+    return {"date": date_range}
+
+
+def get_price_documents(isin, historical_data):
+    documents = []
+    for date_price in historical_data:
+        documents.append({"isin": isin, "date": datetime.datetime.strptime(date_price["date"], "%Y-%m-%d"),
+                          "close": date_price["close"]})
+    return documents
+
+
+def get_date_price(document):
+    return {"date": document["date"].strftime("%Y-%m-%d"), "close": document["close"]}
+
+
+def get_history_summary(historical_data):
+    """ Stored in the ETF document, so the metadata is enough to know how much data an ETF has."""
+    if len(historical_data) == 0:
+        return {"daysWithData": 0, "lastDate": None}
+    return {"daysWithData": len(historical_data), "lastDate": historical_data[-1]["date"]}
+
+
+def get_history_update(etf, historical_data):
+    """ The RIC is stored with the summary, so later updates append prices of the same listing."""
+    history_update = get_history_summary(historical_data)
+    history_update["data.historicalDataRIC"] = etf.get_historical_data_ric()
+    return {'$set': history_update}
+
+
+def get_append_update(new_historical_data):
+    return {'$inc': {'daysWithData': len(new_historical_data)}, '$set': {'lastDate': new_historical_data[-1]["date"]}}
 
 
 def clear_test_db():
@@ -1,15 +1,20 @@
-import pandas
-import matplotlib.pyplot as plt
 from ETF import get_split_name_and_isin, get_combined_name_and_isin
-from pypfopt import expected_returns, risk_models, plotting, discrete_allocation
-from pypfopt.efficient_frontier import EfficientFrontier
+from cache import LRUCache
+import covarianceModels
+import frontierImages
+import timing
 import base64
-import io
+import copy
+import hashlib
+import json
 import numpy as np
 import math
-from timeit import default_timer
+import os
 
 OPTIMIZERS = ["MaxSharpe", "MinimumVolatility", "EfficientRisk", "EfficientReturn"]
+COVARIANCE_MODELS = ["sample", "ledoitWolf", "factor"]
+
+# pypfopt and cvxpy take seconds to import, they're imported where they're used so the server starts without them
 
 INITIAL_VALUE = 10000
 OPTIMIZER = "MaxSharpe"
@@ -18,60 +23,341 @@ MINIMUM_DAYS_WITH_DATA = 0
 ASSET_WEIGHT_CUTOFF = 0.01
 ASSET_WEIGHT_ROUNDING = 4
 ROLLING_WINDOW_IN_DAYS = 0
+COVARIANCE_MODEL = "sample"
+N_FACTORS = 20
 MAX_ETF_LIST_SIZE = 400
 N_EF_PLOTTING_POINTS = 10
+EMBED_EFFICIENT_FRONTIER_IMAGE = False
+
+# The solve time of the dense covariance models grows with the square of the number of ETFs, the factor model is solved
+# in factored form and takes many more
+MAX_ETF_LIST_SIZES = {
+    "sample": MAX_ETF_LIST_SIZE,
+    "ledoitWolf": MAX_ETF_LIST_SIZE,
+    "factor": 3000
+}
+
+# Applied to optimizerParameters before they're used in the key of the result cache
+OPTIMIZER_PARAMETER_DEFAULTS = {
+    "optimizer": OPTIMIZER,
+    "riskFreeRate": RISK_FREE_RATE,
+    "assetCutoff": ASSET_WEIGHT_CUTOFF,
+    "assetRounding": ASSET_WEIGHT_ROUNDING,
+    "initialValue": INITIAL_VALUE,
+    "rollingWindowInDays": ROLLING_WINDOW_IN_DAYS,
+    "finalDate": None,
+    "covarianceModel": COVARIANCE_MODEL,
+    "nEFPlottingPoints": N_EF_PLOTTING_POINTS,
+    "embedEfficientFrontierImage": EMBED_EFFICIENT_FRONTIER_IMAGE
+}
+
+COVARIANCE_CACHE_MAX_BYTES = int(os.environ.get('COVARIANCE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+RESULT_CACHE_TTL_IN_SECONDS = int(os.environ.get('RESULT_CACHE_TTL_IN_SECONDS', 3600))
+OPTIMIZE_BATCH_MAX_SIZE = int(os.environ.get('OPTIMIZE_BATCH_MAX_SIZE', 20))
+
+# Returns, covariance and latest prices only depend on the ETFs, the window and the dataset, not on the optimizer
+covariance_cache = LRUCache(COVARIANCE_CACHE_MAX_BYTES)
+
+# Whole optimize responses, by dataset version and canonical request
+result_cache = LRUCache(RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL_IN_SECONDS)
+
+
+def optimize_with_result_cache(dataset, optimizer_parameters, etf_filters, solver_pool=None):
+    """ Equivalent requests on the same dataset get the same result, concurrent ones wait for the first to compute it.
+        With a solver pool the optimization runs in one of its workers and only the plot is added in this process."""
+    key = (dataset.version, get_canonical_request(optimizer_parameters, etf_filters))
+
+    def compute():
+        if solver_pool is None:
+            return optimize(dataset, optimizer_parameters, etf_filters)
+
+        portfolio, plot = solver_pool.run(dataset, get_optimization, optimizer_parameters, etf_filters)
+        add_efficient_frontier_plot(portfolio, plot, optimizer_parameters)
+        return portfolio
+
+    result = result_cache.get_or_compute(key, compute, get_result_size_in_bytes)
+
+    # The plot behind the image id of a cached result can be evicted before the result
+    if not has_efficient_frontier_plot(result):
+        result_cache.remove(key)
+        result = result_cache.get_or_compute(key, compute, get_result_size_in_bytes)
+
+    return copy.deepcopy(result)
+
+
+def has_efficient_frontier_plot(result):
+    image_id = result.get("efficientFrontierImageId")
+    return image_id is None or frontierImages.has_efficient_frontier_plot(image_id)
+
+
+def optimize_batch(dataset, optimizer_parameters_list, etf_filters, solver_pool=None):
+    """ Optimizes the ETFs matching the filters with every set of parameters and returns the results in the same order.
+        Results are taken from the result cache when possible. The others are grouped by data window, so the returns
+        and covariance are computed once per window, and with a solver pool the windows are spread over its workers. A
+        set of parameters that fails gets its error as its result instead of failing the batch."""
+    if len(optimizer_parameters_list) == 0:
+        raise Exception("No optimizer parameters provided.")
+    if len(optimizer_parameters_list) > OPTIMIZE_BATCH_MAX_SIZE:
+        raise Exception("A batch can have at most {} sets of optimizer parameters.".format(OPTIMIZE_BATCH_MAX_SIZE))
+
+    with timing.span("optimizeBatch") as batch_span:
+        results = [None] * len(optimizer_parameters_list)
+
+        # Equivalent parameters in the same batch are only optimized once
+        indexes_by_key = {}
+        for index, optimizer_parameters in enumerate(optimizer_parameters_list):
+            key = (dataset.version, get_canonical_request(optimizer_parameters, etf_filters))
+            cached = result_cache.get(key)
+            if cached is not None and has_efficient_frontier_plot(cached):
+                results[index] = copy.deepcopy(cached)
+            else:
+                indexes_by_key.setdefault(key, []).append(index)
+
+        if len(indexes_by_key) > 0:
+            parameters_by_key = {key: optimizer_parameters_list[indexes[0]] for key, indexes in indexes_by_key.items()}
+            for key, result in compute_batch(dataset, parameters_by_key, etf_filters, solver_pool).items():
+                for index in indexes_by_key[key]:
+                    results[index] = copy.deepcopy(result)
+
+    print("Time to optimize a batch of {} {}".format(len(optimizer_parameters_list), batch_span.seconds))
+
+    return {"results": results}
+
+
+def compute_batch(dataset, parameters_by_key, etf_filters, solver_pool=None):
+    """ Results by result cache key. The batch takes at most one task per solver worker, all of them or none, so a batch
+        never takes more of the pool than a request per worker would."""
+    windows = {}
+    for key, optimizer_parameters in parameters_by_key.items():
+        windows.setdefault(get_data_window(optimizer_parameters), {})[key] = optimizer_parameters
+    windows = list(windows.values())
+
+    if solver_pool is None:
+        optimizations = get_batch_optimizations(dataset, windows, etf_filters)
+    else:
+        tasks = min(solver_pool.workers, len(windows))
+        optimizations = {}
+        for task_optimizations in solver_pool.run_all(dataset, get_batch_optimizations,
+                                                      [(windows[task::tasks], etf_filters) for task in range(tasks)]):
+            optimizations.update(task_optimizations)
+
+    results = {}
+    for key, (portfolio, plot) in optimizations.items():
+        if "error" not in portfolio:
+            add_efficient_frontier_plot(portfolio, plot, parameters_by_key[key])
+            result_cache.put(key, portfolio, get_result_size_in_bytes(portfolio))
+        results[key] = portfolio
+
+    return results
+
+
+def get_batch_optimizations(dataset, windows, etf_filters):
+    """ The portfolio and frontier plot of every result cache key of the windows, which are dicts of the optimizer
+        parameters by key that share their data window. A key that fails gets its error as its portfolio. Like
+        get_optimization, this can run in another process."""
+    etf_list = filter_etfs_using_filters(dataset.etf_index, etf_filters)
+
+    optimizations = {}
+    for parameters_by_key in windows:
+        try:
+            returns, cov, latest_prices = get_returns_and_covariance(dataset, etf_list,
+                                                                     next(iter(parameters_by_key.values())))
+        except Exception as e:
+            print("Exception: ", e)
+            optimizations.update({key: ({"error": str(e)}, None) for key in parameters_by_key})
+            continue
 
+        volatility = covarianceModels.get_volatility(cov)
+
+        # Parameters that only differ in the optimizer share the points of their frontier
+        frontiers = {}
+        for key, optimizer_parameters in parameters_by_key.items():
+            try:
+                weights, performance = get_optimized_weights(returns, cov, optimizer_parameters)
+                portfolio = get_portfolio_and_performance(weights, performance, latest_prices, optimizer_parameters,
+                                                          returns, volatility)
+
+                plot = None
+                points = optimizer_parameters.get("nEFPlottingPoints", N_EF_PLOTTING_POINTS)
+                if points > 0:
+                    if points not in frontiers:
+                        frontiers[points] = get_efficient_frontier_points(returns, cov, points)
+                    frontier_points, frontier_weights = frontiers[points]
+                    plot = add_efficient_frontier_points(portfolio, frontier_points, frontier_weights, volatility,
+                                                         returns)
+
+                portfolio["ETFsMatchingFilters"] = len(etf_list)
+                portfolio["ETFsUsedForOptimization"] = len(etf_list)
+                optimizations[key] = (portfolio, plot)
+            except Exception as e:
+                print("Exception: ", e)
+                optimizations[key] = ({"error": str(e)}, None)
+
+    return optimizations
+
+
+def get_canonical_request(optimizer_parameters, etf_filters):
+    """ The parameters and filters with their defaults applied and the values that don't change the result left out,
+        serialized with sorted keys."""
+    parameters = dict(optimizer_parameters)
+    for name, default in OPTIMIZER_PARAMETER_DEFAULTS.items():
+        parameters.setdefault(name, default)
+    parameters.setdefault("maxETFListSize", get_max_etf_list_size(parameters))
+
+    if parameters["covarianceModel"] == "factor":
+        parameters.setdefault("nFactors", N_FACTORS)
+    else:
+        parameters.pop("nFactors", None)
 
-def optimize(etf_list, prices_df, optimizer_parameters, etf_filters):
+    if parameters["optimizer"] != "EfficientRisk":
+        parameters.pop("targetVolatility", None)
+    if parameters["optimizer"] != "EfficientReturn":
+        parameters.pop("targetReturn", None)
 
-    start = default_timer()
+    filters = {name: value for name, value in etf_filters.items() if value is not None}
+    filters.setdefault("minimumDaysWithData", MINIMUM_DAYS_WITH_DATA)
+    if "isinList" in filters:
+        filters["isinList"] = sorted(set(filters["isinList"]))
 
-    etf_list = filter_etfs_using_filters(etf_list, etf_filters)
-    etfs_matching_filters = len(etf_list)
+    return json.dumps({"optimizerParameters": parameters, "etfFilters": filters}, sort_keys=True, separators=(",", ":"))
 
-    rolling_window_in_days = optimizer_parameters.get("rollingWindowInDays", ROLLING_WINDOW_IN_DAYS)
-    final_date = optimizer_parameters.get("finalDate", None)
-    prices = get_prices_data_frame_with_parameters(etf_list, prices_df, rolling_window_in_days, final_date)
 
-    prices, etf_size_list = size_check_prices_df(prices, optimizer_parameters)
+def get_result_size_in_bytes(result):
+    return len(json.dumps(result, default=str))
 
-    returns = expected_returns.mean_historical_return(prices)
-    remove_ter_from_returns(etf_list, returns)
 
-    cov = risk_models.sample_cov(prices)
-    volatility = pandas.Series(np.sqrt(np.diag(cov)), index=cov.index)
+def optimize(dataset, optimizer_parameters, etf_filters, covariance_engine=None):
+    portfolio, plot = get_optimization(dataset, optimizer_parameters, etf_filters, covariance_engine)
+    add_efficient_frontier_plot(portfolio, plot, optimizer_parameters)
 
-    ef = EfficientFrontier(returns, cov, weight_bounds=(0, 1), solver_options={"solver": "ECOS"}, verbose=False)
+    return portfolio
 
-    n_ef_plotting_points = optimizer_parameters.get("nEFPlottingPoints", N_EF_PLOTTING_POINTS)
 
-    if n_ef_plotting_points > 0:
-        fig, ax = plt.subplots()
-        param_range = get_plotting_param_range(ef, n_ef_plotting_points)
-        plotting.plot_efficient_frontier(ef, ax=ax, points=n_ef_plotting_points, ef_param_range=param_range, show_assets=True)
+def get_optimization(dataset, optimizer_parameters, etf_filters, covariance_engine=None):
+    """ The portfolio with the points of its efficient frontier, and the plot of the frontier or None if it has no
+        points. The plot isn't added to the frontier images, so this can run in another process."""
+    with timing.span("optimize") as optimize_span:
+        etf_list = filter_etfs_using_filters(dataset.etf_index, etf_filters)
+        etfs_matching_filters = len(etf_list)
 
-        call_optimizer(ef, optimizer_parameters)
+        returns, cov, latest_prices = get_returns_and_covariance(dataset, etf_list, optimizer_parameters,
+                                                                 covariance_engine)
+        volatility = covarianceModels.get_volatility(cov)
 
-        portfolio = get_portfolio_and_performance(ef, prices, optimizer_parameters, returns, volatility)
+        n_ef_plotting_points = optimizer_parameters.get("nEFPlottingPoints", N_EF_PLOTTING_POINTS)
 
-        plot_assets_in_portfolio_with_different_color(portfolio, ax, volatility, returns)
-        add_plot_to_portfolio(portfolio, ax, fig)
-    else:
-        call_optimizer(ef, optimizer_parameters)
+        weights, performance = get_optimized_weights(returns, cov, optimizer_parameters)
 
-        portfolio = get_portfolio_and_performance(ef, prices, optimizer_parameters, returns, volatility)
+        portfolio = get_portfolio_and_performance(weights, performance, latest_prices, optimizer_parameters, returns,
+                                                  volatility)
 
-    end = default_timer()
-    print("Time to find max sharpe {}".format(end - start))
+        plot = None
+        if n_ef_plotting_points > 0:
+            frontier_points, frontier_weights = get_efficient_frontier_points(returns, cov, n_ef_plotting_points)
+            plot = add_efficient_frontier_points(portfolio, frontier_points, frontier_weights, volatility, returns)
+
+    print("Time to find max sharpe {}".format(optimize_span.seconds))
 
     portfolio["ETFsMatchingFilters"] = etfs_matching_filters
     portfolio["ETFsUsedForOptimization"] = len(etf_list)
 
-    return portfolio
+    return portfolio, plot
+
+
+def get_returns_and_covariance(dataset, etf_list, optimizer_parameters, covariance_engine=None, use_cache=True):
+    """ Backtrades pass use_cache=False, every rebalance window is used once and would only evict the windows that
+        optimize requests share."""
+    rolling_window_in_days = optimizer_parameters.get("rollingWindowInDays", ROLLING_WINDOW_IN_DAYS)
+    final_date = optimizer_parameters.get("finalDate", None)
+    covariance_model = optimizer_parameters.get("covarianceModel", COVARIANCE_MODEL)
+    n_factors = optimizer_parameters.get("nFactors", N_FACTORS) if covariance_model == "factor" else None
+
+    if covariance_model not in COVARIANCE_MODELS:
+        raise Exception("The covariance model provided isn't valid. Provide one of: {}".format(COVARIANCE_MODELS))
+
+    key = get_covariance_cache_key(dataset, etf_list, get_data_window(optimizer_parameters))
+    cached = covariance_cache.get(key) if use_cache else None
+    if cached is not None:
+        return cached
+
+    with timing.span("pricesWindow"):
+        prices = get_prices_data_frame_with_parameters(etf_list, dataset.prices_df, rolling_window_in_days, final_date)
+
+        prices, etf_size_list = size_check_prices_df(prices, optimizer_parameters)
+        prices = drop_etfs_without_common_returns(prices)
+
+    from pypfopt import expected_returns, discrete_allocation
+
+    with timing.span("expectedReturns"):
+        returns = expected_returns.mean_historical_return(prices)
+        returns = remove_ter_from_returns(dataset.ters, returns)
+
+    cov = get_covariance(prices, covariance_model, n_factors, covariance_engine)
+
+    latest_prices = discrete_allocation.get_latest_prices(prices)
+
+    if use_cache:
+        size_in_bytes = returns.memory_usage() + covarianceModels.get_size_in_bytes(cov) + latest_prices.memory_usage()
+        covariance_cache.put(key, (returns, cov, latest_prices), int(size_in_bytes))
 
+    return returns, cov, latest_prices
 
-def get_plotting_param_range(ef, points):
-    param_range = plotting._ef_default_returns_range(ef, points=points)
+
+def get_covariance(prices, covariance_model, n_factors, covariance_engine=None):
+    """ The covariance engine only computes the sample covariance, the other models are estimated from the prices."""
+    from pypfopt import risk_models
+
+    with timing.span("covariance") as covariance_span:
+        if covariance_model == "ledoitWolf":
+            cov = covarianceModels.get_ledoit_wolf_covariance(prices)
+        elif covariance_model == "factor":
+            cov = covarianceModels.get_factor_covariance(prices, n_factors)
+        elif covariance_engine is not None:
+            cov = covariance_engine.get_covariance(prices)
+        else:
+            cov = risk_models.sample_cov(prices)
+
+    print("Time to compute {} covariance of {} ETFs {}".format(covariance_model, len(prices.columns),
+                                                               covariance_span.seconds))
+
+    return cov
+
+
+def get_data_window(optimizer_parameters):
+    """ The parameters the returns and covariance depend on. Parameters with the same data window share them."""
+    covariance_model = optimizer_parameters.get("covarianceModel", COVARIANCE_MODEL)
+    n_factors = optimizer_parameters.get("nFactors", N_FACTORS) if covariance_model == "factor" else None
+
+    return (optimizer_parameters.get("rollingWindowInDays", ROLLING_WINDOW_IN_DAYS),
+            str(optimizer_parameters.get("finalDate", None)), get_max_etf_list_size(optimizer_parameters),
+            covariance_model, n_factors)
+
+
+def get_covariance_cache_key(dataset, etf_list, data_window):
+    etfs = hashlib.sha1()
+    for etf in etf_list:
+        etfs.update(get_combined_name_and_isin(etf.get_name(), etf.get_isin()).encode())
+        etfs.update(b"\n")
+
+    return (dataset.version, etfs.hexdigest()) + data_window
+
+
+def get_efficient_frontier_points(returns, cov, points):
+    """ The frontier as data, a table of its points with their solve times and a table of their weights."""
+    from frontier import EfficientFrontierSweep
+
+    with timing.span("efficientFrontier") as frontier_span:
+        frontier_sweep = EfficientFrontierSweep(returns, cov)
+        frontier_points, frontier_weights = frontier_sweep.sweep(get_plotting_param_range(frontier_sweep, points))
+
+    print("Time to compute efficient frontier of {} points {}".format(len(frontier_points), frontier_span.seconds))
+
+    return frontier_points, frontier_weights
+
+
+def get_plotting_param_range(frontier_sweep, points):
+    param_range = frontier_sweep.get_default_target_returns(points)
 
     if param_range[0] < 0:
         return np.linspace(0, param_range[-1], points)
@@ -88,7 +374,7 @@ def size_check_prices_df(prices, optimizer_parameters):
     if etf_list_size_after_filtering == 1:
         raise Exception("Can't perform portfolio optimization on just one ETF.")
 
-    max_etf_list_size = optimizer_parameters.get("maxETFListSize", MAX_ETF_LIST_SIZE)
+    max_etf_list_size = get_max_etf_list_size(optimizer_parameters)
     if etf_list_size_after_filtering > max_etf_list_size:
         print("Too many ETFs, calculation will take too long. Using only the first {} ETFs".format(max_etf_list_size))
         prices = prices.iloc[:, :max_etf_list_size]
@@ -96,7 +382,63 @@ def size_check_prices_df(prices, optimizer_parameters):
     return prices, etf_list_size_after_filtering
 
 
-def filter_etfs_using_filters(etf_list, etf_filters):
+def drop_etfs_without_common_returns(prices):
+    """ The covariance of two ETFs needs at least two days on which both have a return, a single pair without them
+        makes the whole sample covariance NaN once it's fixed to be positive semidefinite. The ETF with the fewest
+        returns of such a pair is dropped until there are none left. Two ETFs with n and m returns over d days share at
+        least n + m - d of them, so only the overlaps of the ETFs with a short history in the window are counted."""
+    present = prices.notna().to_numpy()
+    has_return = (present[1:] & present[:-1]).astype(np.float64)
+    return_counts = has_return.sum(axis=0)
+
+    short_histories = np.flatnonzero(return_counts + return_counts.min() < len(has_return) + 2)
+    if len(short_histories) == 0:
+        return prices
+
+    common_returns = has_return[:, short_histories].T @ has_return
+    keep = np.ones(len(prices.columns), dtype=bool)
+    while True:
+        lacking = keep[short_histories] & (common_returns[:, keep] < 2).any(axis=1)
+        if not lacking.any():
+            break
+
+        candidates = short_histories[lacking]
+        keep[candidates[np.argmin(return_counts[candidates])]] = False
+
+    if keep.all():
+        return prices
+
+    print("Dropped {} ETFs that have less than two days of returns in common with another ETF".format(
+        len(keep) - keep.sum()))
+    if keep.sum() < 2:
+        raise Exception("Can't perform portfolio optimization on just one ETF.")
+
+    return prices.loc[:, keep]
+
+
+def get_max_etf_list_size(optimizer_parameters):
+    """ The size given in the parameters, or the default of their covariance model."""
+    max_etf_list_size = optimizer_parameters.get("maxETFListSize")
+    if max_etf_list_size is not None:
+        return max_etf_list_size
+
+    covariance_model = optimizer_parameters.get("covarianceModel", COVARIANCE_MODEL)
+    return MAX_ETF_LIST_SIZES.get(covariance_model, MAX_ETF_LIST_SIZE)
+
+
+def filter_etfs_using_filters(etf_index, etf_filters):
+    with timing.span("filterETFs"):
+        etfs_with_filters = etf_index.get_etfs(get_etfs_matching_filters_mask(etf_index, etf_filters))
+    print("Filtered ETFs by the parameters provided: {} ETFs left".format(len(etfs_with_filters)))
+
+    return etfs_with_filters
+
+
+def count_etfs_matching_filters(etf_index, etf_filters):
+    return int(np.count_nonzero(get_etfs_matching_filters_mask(etf_index, etf_filters)))
+
+
+def get_etfs_matching_filters_mask(etf_index, etf_filters):
     isin_list = etf_filters.get("isinList", None)
     minimum_days_with_data = etf_filters.get("minimumDaysWithData")
     if minimum_days_with_data is None:
@@ -106,34 +448,52 @@ def filter_etfs_using_filters(etf_list, etf_filters):
     distribution_policy = etf_filters.get("distributionPolicy", None)
     fund_currency = etf_filters.get("fundCurrency", None)
 
-    etfs_with_data = []
-    for etf in etf_list:
-        if len(etf.get_historical_data()) >= minimum_days_with_data:
-            etfs_with_data.append(etf)
-    print("Filtered ETFs that don't have enough data: {} ETFs left".format(len(etfs_with_data)))
+    mask = etf_index.with_minimum_days_with_data(minimum_days_with_data)
 
-    etfs_with_filters = []
-    for etf in etfs_with_data:
+    if isin_list is not None:
+        mask &= etf_index.with_isins(isin_list)
 
-        if isin_list is not None and etf.get_isin() not in isin_list:
-            continue
+    if domicile_country is not None:
+        mask &= etf_index.with_domicile_country(domicile_country)
 
-        if domicile_country is not None and domicile_country != etf.get_domicile_country():
-            continue
+    if replication_method is not None:
+        mask &= etf_index.with_replication_method(replication_method)
 
-        if replication_method is not None and replication_method != etf.get_replication_method():
-            continue
+    if distribution_policy is not None:
+        mask &= etf_index.with_distribution_policy(distribution_policy)
 
-        if distribution_policy is not None and distribution_policy != etf.get_distribution_policy():
-            continue
+    if fund_currency is not None:
+        mask &= etf_index.with_fund_currency(fund_currency)
 
-        if fund_currency is not None and fund_currency != etf.get_fund_currency():
-            continue
+    return mask
 
-        etfs_with_filters.append(etf)
-    print("Filtered ETFs by the parameters provided: {} ETFs left".format(len(etfs_with_filters)))
 
-    return etfs_with_filters
+def get_efficient_frontier(returns, cov):
+    if isinstance(cov, covarianceModels.FactorCovariance):
+        from factorEfficientFrontier import FactorEfficientFrontier
+        return FactorEfficientFrontier(returns, cov)
+
+    from pypfopt.efficient_frontier import EfficientFrontier
+    return EfficientFrontier(returns, cov, weight_bounds=(0, 1), solver="ECOS", verbose=False)
+
+
+def get_optimized_weights(returns, cov, optimizer_parameters):
+    """ Only depends on its arguments, so it can run in another process."""
+    with timing.span("solve"):
+        ef = get_efficient_frontier(returns, cov)
+        call_optimizer(ef, optimizer_parameters)
+        return get_cleaned_weights_and_performance(ef, optimizer_parameters)
+
+
+def get_cleaned_weights_and_performance(ef, optimizer_parameters):
+    risk_free_rate = optimizer_parameters.get("riskFreeRate", RISK_FREE_RATE)
+    asset_cutoff = optimizer_parameters.get("assetCutoff", ASSET_WEIGHT_CUTOFF)
+    asset_rounding = optimizer_parameters.get("assetRounding", ASSET_WEIGHT_ROUNDING)
+
+    weights = ef.clean_weights(cutoff=asset_cutoff, rounding=asset_rounding)
+    performance = ef.portfolio_performance(risk_free_rate=risk_free_rate)
+
+    return weights, performance
 
 
 def call_optimizer(ef, optimizer_parameters):
@@ -164,19 +524,15 @@ def call_optimizer(ef, optimizer_parameters):
         raise Exception("The optimizer provided isn't valid. Provide one of: {}".format(OPTIMIZERS))
 
 
-def get_portfolio_and_performance(ef, prices, optimizer_parameters, returns, variance):
+def get_portfolio_and_performance(sharpe_pwt, performance, latest_prices, optimizer_parameters, returns, variance):
 
-    initial_value = optimizer_parameters.get("initialValue", INITIAL_VALUE)
-    risk_free_rate = optimizer_parameters.get("riskFreeRate", RISK_FREE_RATE)
-    asset_cutoff = optimizer_parameters.get("assetCutoff", ASSET_WEIGHT_CUTOFF)
-    asset_rounding = optimizer_parameters.get("assetRounding", ASSET_WEIGHT_ROUNDING)
+    from pypfopt import discrete_allocation
 
-    sharpe_pwt = ef.clean_weights(cutoff=asset_cutoff, rounding=asset_rounding)
-    performance = ef.portfolio_performance(risk_free_rate=risk_free_rate)
+    initial_value = optimizer_parameters.get("initialValue", INITIAL_VALUE)
 
-    latest_prices = discrete_allocation.get_latest_prices(prices)
-    allocation = discrete_allocation.DiscreteAllocation(sharpe_pwt, latest_prices, initial_value)
-    alloc, leftover_funds = allocation.greedy_portfolio()
+    with timing.span("discreteAllocation"):
+        allocation = discrete_allocation.DiscreteAllocation(sharpe_pwt, latest_prices, initial_value)
+        alloc, leftover_funds = allocation.greedy_portfolio()
 
     portfolio = []
     total_weight = 0
@@ -212,101 +568,50 @@ def get_portfolio_and_performance(ef, prices, optimizer_parameters, returns, var
     return result
 
 
-def plot_assets_in_portfolio_with_different_color(portfolio, ax, volatility, returns):
-    volatility_list = []
-    return_list = []
-
-    for etf in portfolio["portfolio"]:
-        etf_combined_name = get_combined_name_and_isin(etf["name"], etf["isin"])
+def add_efficient_frontier_points(portfolio, frontier_points, frontier_weights, volatility, returns):
+    """ The frontier is returned as points with their target return, solve time and weights, and the plot of it is
+        returned to be added to the frontier images."""
+    with timing.span("efficientFrontierPlot"):
+        frontier = frontier_points[["targetReturn", "expectedReturn", "volatility", "solveTime"]].to_dict("records")
+        for point, (_, weights) in zip(frontier, frontier_weights.iterrows()):
+            point["weights"] = get_frontier_point_weights(weights)
 
-        volatility_list.append(volatility[etf_combined_name])
-        return_list.append(returns[etf_combined_name])
+        plot = frontierImages.get_efficient_frontier_plot(frontier, volatility, returns, portfolio)
 
-    ax.scatter(
-        volatility_list,
-        return_list,
-        s=30,
-        color="g",
-        label="assets in portfolio",
-    )
+    portfolio["efficientFrontier"] = frontier
+    return plot
 
 
-def add_plot_to_portfolio(portfolio, ax, fig):
-    ax.scatter(portfolio["annualVolatility"], portfolio["expectedReturn"], marker="*", s=100, c="r", label="Optimized Portfolio")
-    ax.set_title("Efficient Frontier")
-    ax.legend()
-    fig.tight_layout()
+def get_frontier_point_weights(weights):
+    """ Weights of a point of the frontier rounded like the ones of the portfolio, the ETFs under the cutoff are left
+        out to keep the response small."""
+    weights = weights[weights >= ASSET_WEIGHT_CUTOFF].round(ASSET_WEIGHT_ROUNDING).sort_values(ascending=False)
 
-    buf = io.BytesIO()
-    fig.savefig(buf, format="png")
-    buf.seek(0)
-    portfolio["efficientFrontierImage"] = base64.b64encode(buf.getbuffer()).decode("ascii")
-    buf.close()
+    point_weights = []
+    for identifier, weight in weights.items():
+        name, isin = get_split_name_and_isin(identifier)
+        point_weights.append({"name": name, "isin": isin, "weight": float(weight)})
+    return point_weights
 
 
-def remove_ter_from_returns(etf_list, returns):
-
-    for index, row in returns.items():
-        for etf in etf_list:
-            if etf.get_name() == index:
-                returns.loc[index] = row - etf.get_ter()
-
-
-def get_complete_prices_data_frame(etf_list):
-
-    start = default_timer()
-
-    prices_by_date = {}
-
-    for etf in etf_list:
-
-        if len(etf.get_historical_data()) == 0:
-            continue
-
-        identifier = get_combined_name_and_isin(etf.get_name(), etf.get_isin())
-
-        dates = {}
-        historical_data = etf.get_historical_data()
-        last_50 = []
-        for i in range(len(historical_data)):
-            date_price = historical_data[i]
-
-            date = date_price["date"]
-            price = date_price["close"]
-
-            # Fixes ETFs that have 0 as their first value and then get an infinite return
-            if price == 0:
-                price = float("nan")
-
-            # Fixes ETFs that have 1 day with a completely wrong value
-            previous_price = historical_data[i-1]["close"] if i > 0 else float("nan")
-            next_price = historical_data[i+1]["close"] if i < len(historical_data) - 1 else float("nan")
-            if not math.isnan(previous_price) and previous_price != 0 and (0.2 > (price / previous_price) or 5 < (price / previous_price)):
-                price = float("nan")
-            elif not math.isnan(next_price) and next_price != 0 and (0.2 > (price / next_price) or 5 < (price / next_price)):
-                price = float("nan")
-            elif len(last_50) > 0:
-                last_50_avg = sum(last_50) / len(last_50)
-                if 0.2 > (price / last_50_avg) or 5 < (price / last_50_avg):
-                    price = float("nan")
-
-            if not math.isnan(price):
-                last_50.append(price)
-
-            if len(last_50) == 50:
-                last_50 = last_50[1:]
+def add_efficient_frontier_plot(portfolio, plot, optimizer_parameters):
+    """ The image of the frontier is rendered on request from the id, unless it's asked to be embedded in the
+        response."""
+    if plot is None:
+        return
 
-            dates[date] = price
+    embed_image = optimizer_parameters.get("embedEfficientFrontierImage", EMBED_EFFICIENT_FRONTIER_IMAGE)
 
-        prices_by_date[identifier] = dates
+    image_id = frontierImages.add_efficient_frontier_plot(plot)
+    portfolio["efficientFrontierImageId"] = image_id
 
-    df = pandas.DataFrame(prices_by_date)
-    df.sort_index(inplace=True)
+    if embed_image:
+        image = frontierImages.get_efficient_frontier_image(image_id)
+        portfolio["efficientFrontierImage"] = base64.b64encode(image).decode("ascii")
 
-    end = default_timer()
-    print("Time to build prices dataframe {}".format(end - start))
 
-    return df
+def remove_ter_from_returns(ters, returns):
+    return returns - ters.reindex(returns.index, fill_value=0)
 
 
 def get_prices_data_frame_with_parameters(etf_list, prices_df, rolling_window_in_days, final_date):
@@ -335,6 +640,6 @@ def get_prices_data_frame_with_parameters(etf_list, prices_df, rolling_window_in
         if at_least_three_prices < 3:
             etfs_to_drop.append(etf)
 
-    prices_df = prices_df.drop(etfs_to_drop, 1)
+    prices_df = prices_df.drop(columns=etfs_to_drop)
 
     return prices_df
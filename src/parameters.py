@@ -22,5 +22,7 @@ def get_parameters(etf_list):
         "distributionPolicies": distribution_policies,
         "replicationMethods": replication_methods,
         "fundCurrencies": fund_currencies,
-        "optimizers": optimizer.OPTIMIZERS
+        "optimizers": optimizer.OPTIMIZERS,
+        "covarianceModels": optimizer.COVARIANCE_MODELS,
+        "maxETFListSizes": optimizer.MAX_ETF_LIST_SIZES
     }
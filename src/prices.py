@@ -0,0 +1,337 @@
+import numpy as np
+import pandas
+from ETF import ETF, get_combined_name_and_isin, get_history_arrays
+from mongoDB import get_etf_list_with_data, stream_prices, get_etf_historical_data, get_etf_historical_data_tails, \
+    PRODUCTION_DB_NAME
+from timeit import default_timer
+import timing
+import json
+import os
+import shutil
+
+OUTLIER_RATIO = 5
+# The trailing window is dropped to 49 prices as soon as it reaches 50, so the mean never uses more than 49 prices
+TRAILING_PRICES = 50
+
+# The tail read from MongoDB holds the prices of the last APPEND_TAIL_DAYS calendar days of the data frame and after,
+# ETFs with more new days than fit in it are cleaned again from their full history
+APPEND_TAIL_DAYS = 100
+
+# Absolute, so the same snapshot is found whatever directory the server or this script is started from
+PRICES_SNAPSHOT_PATH = os.path.abspath(os.environ.get('PRICES_SNAPSHOT_PATH', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "prices-snapshot")))
+
+SNAPSHOT_PRICES_FILE = "prices.npy"
+SNAPSHOT_DATES_FILE = "dates.npy"
+SNAPSHOT_IDENTIFIERS_FILE = "identifiers.json"
+SNAPSHOT_ETFS_FILE = "etfs.json"
+
+
+def main():
+    etf_list, prices_df = load_prices_data_frame(PRODUCTION_DB_NAME)
+    save_prices_snapshot(etf_list, prices_df, PRICES_SNAPSHOT_PATH)
+
+
+def load_prices_data_frame(db_name):
+    """ Loads the ETFs with data and their prices data frame from MongoDB. The prices are streamed one ETF at a time and
+        cleaned as soon as they arrive, so only their arrays are kept instead of the documents, and the ETFs are left
+        without historical data."""
+
+    start = default_timer()
+
+    etf_list = get_etf_list_with_data(db_name)
+
+    identifiers_by_isin = {}
+    for etf in etf_list:
+        identifier = get_combined_name_and_isin(etf.get_name(), etf.get_isin())
+        identifiers_by_isin.setdefault(etf.get_isin(), []).append(identifier)
+
+    streamed_prices = {}
+    with timing.span("streamPrices"):
+        for isin, dates, closes in stream_prices(db_name):
+            if isin not in identifiers_by_isin or len(dates) == 0:
+                continue
+
+            prices = clean_closes(closes)
+            for identifier in identifiers_by_isin[isin]:
+                streamed_prices[identifier] = (dates, prices)
+
+    # Same column order as the ETF list, like the data frame built from the ETFs' historical data
+    prices_by_identifier = {}
+    for etf in etf_list:
+        identifier = get_combined_name_and_isin(etf.get_name(), etf.get_isin())
+        if identifier in streamed_prices:
+            prices_by_identifier[identifier] = streamed_prices[identifier]
+
+    df = build_prices_data_frame(prices_by_identifier)
+
+    end = default_timer()
+    print("Time to load prices dataframe {}".format(end - start))
+
+    return etf_list, df
+
+
+def get_complete_prices_data_frame(etf_list):
+
+    start = default_timer()
+
+    prices_by_identifier = {}
+
+    for etf in etf_list:
+
+        if len(etf.get_dates()) == 0:
+            continue
+
+        identifier = get_combined_name_and_isin(etf.get_name(), etf.get_isin())
+        prices_by_identifier[identifier] = (etf.get_dates(), clean_closes(etf.get_closes()))
+
+    df = build_prices_data_frame(prices_by_identifier)
+
+    end = default_timer()
+    print("Time to build prices dataframe {}".format(end - start))
+
+    return df
+
+
+def build_prices_data_frame(prices_by_identifier):
+    if len(prices_by_identifier) == 0:
+        return pandas.DataFrame()
+
+    all_dates = np.unique(np.concatenate([dates for dates, _ in prices_by_identifier.values()]))
+
+    # Column-major so that every ETF's prices are contiguous, which is how pandas stores the columns
+    matrix = np.full((len(all_dates), len(prices_by_identifier)), np.nan, order="F")
+    for column, (dates, prices) in enumerate(prices_by_identifier.values()):
+        matrix[np.searchsorted(all_dates, dates), column] = prices
+
+    return pandas.DataFrame(matrix, index=all_dates.astype(str).astype(object), columns=list(prices_by_identifier), copy=False)
+
+
+def append_historical_data(etf_list, prices_df, db_name):
+    """ Appends the days that were added to MongoDB since the ETFs were loaded. Cleaning only depends on the neighbouring
+        closes and the trailing valid prices, so only the previous last day and the new days are cleaned again.
+        Returns a new ETF list and prices data frame, the ones passed in are left untouched for requests using them."""
+
+    start = default_timer()
+
+    index_dates = prices_df.index.to_numpy().astype("datetime64[D]")
+    tail_start_date = None
+    if len(index_dates) > 0:
+        tail_start_date = str(index_dates[-1] - np.timedelta64(APPEND_TAIL_DAYS, "D"))
+    tails = get_etf_historical_data_tails(db_name, tail_start_date)
+
+    updated_etf_list = []
+    updated_prices = {}
+
+    for etf in etf_list:
+        tail = tails.get(etf.get_isin())
+        old_days_with_data = etf.get_days_with_data()
+
+        if tail is None or tail["daysWithData"] <= old_days_with_data:
+            updated_etf_list.append(etf)
+            continue
+
+        identifier = get_combined_name_and_isin(etf.get_name(), etf.get_isin())
+        new_days = tail["daysWithData"] - old_days_with_data
+        tail_dates, tail_closes = tail["dates"], tail["closes"]
+
+        if identifier in prices_df and old_days_with_data > 0 and new_days + 2 <= len(tail_dates):
+            first = len(tail_dates) - new_days - 1
+            dates = tail_dates[first:]
+
+            column = prices_df[identifier].to_numpy()[:np.searchsorted(index_dates, dates[0])]
+            trailing_prices = column[~np.isnan(column)]
+
+            prices = clean_closes(tail_closes[first:], tail_closes[first - 1], trailing_prices)
+            updated_prices[identifier] = (dates, prices, False)
+        else:
+            if len(tail_dates) < tail["daysWithData"]:
+                tail_dates, tail_closes = get_history_arrays(get_etf_historical_data(etf.get_isin(), db_name))
+
+            updated_prices[identifier] = (tail_dates, clean_closes(tail_closes), True)
+
+        new_historical_data = (tail_dates[-new_days:], tail_closes[-new_days:])
+        updated_etf_list.append(get_etf_with_new_days(etf, new_historical_data, tail["daysWithData"]))
+
+    if len(updated_prices) == 0:
+        print("No new prices found")
+        return etf_list, prices_df, 0
+
+    df = build_appended_prices_data_frame(prices_df, index_dates, updated_prices)
+
+    end = default_timer()
+    print("Time to append prices for {} ETFs {}".format(len(updated_prices), end - start))
+
+    return updated_etf_list, df, len(updated_prices)
+
+
+def get_etf_with_new_days(etf, new_historical_data, days_with_data):
+    if len(etf.get_dates()) > 0:
+        new_dates, new_closes = get_history_arrays(new_historical_data)
+        return ETF(etf.get_id(), etf.get_data(), (np.concatenate((etf.get_dates(), new_dates)),
+                                                  np.concatenate((etf.get_closes(), new_closes))))
+
+    return ETF(etf.get_id(), etf.get_data(), [], days_with_data)
+
+
+def build_appended_prices_data_frame(prices_df, index_dates, updated_prices):
+    all_dates = np.union1d(index_dates, np.concatenate([dates for dates, _, _ in updated_prices.values()]))
+
+    identifiers = list(prices_df.columns)
+    for identifier in updated_prices:
+        if identifier not in prices_df:
+            identifiers.append(identifier)
+    columns = {identifier: column for column, identifier in enumerate(identifiers)}
+
+    matrix = np.full((len(all_dates), len(identifiers)), np.nan, order="F")
+    matrix[np.searchsorted(all_dates, index_dates), :prices_df.shape[1]] = prices_df.to_numpy(dtype=np.float64)
+
+    for identifier, (dates, prices, whole_history) in updated_prices.items():
+        column = columns[identifier]
+        if whole_history:
+            matrix[:, column] = np.nan
+        matrix[np.searchsorted(all_dates, dates), column] = prices
+
+    return pandas.DataFrame(matrix, index=all_dates.astype(str).astype(object), columns=identifiers, copy=False)
+
+
+def clean_closes(closes, previous_close=float("nan"), trailing_prices=()):
+    """ Returns the closes with NaN in place of prices that are zero, that jump by more than OUTLIER_RATIO against the
+        previous or next close, or that deviate by more than OUTLIER_RATIO from the mean of the trailing valid prices.
+        previous_close and trailing_prices allow cleaning only the tail of a series that was already cleaned."""
+
+    closes = np.asarray(closes, dtype=np.float64)
+    trailing_prices = np.asarray(trailing_prices, dtype=np.float64)[-(TRAILING_PRICES - 1):]
+
+    if len(closes) == 0:
+        return closes.copy()
+
+    # Fixes ETFs that have 0 as their first value and then get an infinite return
+    prices = np.where(closes == 0, np.nan, closes)
+
+    # Fixes ETFs that have 1 day with a completely wrong value
+    previous_closes = np.concatenate(([previous_close], closes[:-1]))
+    next_closes = np.concatenate((closes[1:], [np.nan]))
+    valid = ~(np.isnan(prices) | is_outlier(prices, previous_closes) | is_outlier(prices, next_closes))
+
+    # Whether a price is kept depends on the prices kept before it, so the trailing means are recomputed after every
+    # rejected run. Everything before the first price that disagrees with its trailing mean is already final, and the
+    # mean stays the same until the next price that is kept, so each pass settles at least one whole run of prices.
+    start = 0
+    while True:
+        means = get_trailing_means(prices, valid, trailing_prices)
+        outliers = valid & is_outlier(prices, means)
+        outliers[:start] = False
+
+        if not outliers.any():
+            break
+
+        first_outlier = np.argmax(outliers)
+        kept = valid[first_outlier:] & ~is_outlier(prices[first_outlier:], means[first_outlier])
+        next_kept = first_outlier + np.argmax(kept) if kept.any() else len(prices)
+
+        valid[first_outlier:next_kept] = False
+        start = next_kept + 1
+
+    return np.where(valid, prices, np.nan)
+
+
+def is_outlier(prices, reference_prices):
+    reference_prices = np.broadcast_to(reference_prices, prices.shape)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = prices / reference_prices
+
+    return (reference_prices != 0) & ((ratio < 1 / OUTLIER_RATIO) | (ratio > OUTLIER_RATIO))
+
+
+def get_trailing_means(prices, valid, trailing_prices):
+    """ Mean of the last TRAILING_PRICES - 1 valid prices before each position, NaN where there are none."""
+
+    window = TRAILING_PRICES - 1
+
+    sums = np.concatenate(([0.0], np.cumsum(np.concatenate((trailing_prices, prices[valid])))))
+    counts = len(trailing_prices) + np.cumsum(valid) - valid
+    lower = np.maximum(counts - window, 0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (sums[counts] - sums[lower]) / (counts - lower)
+
+
+def get_ters(etf_list, identifiers):
+    """ TER of every ETF aligned with the prices data frame columns, ETFs without a valid TER get 0."""
+    ter_by_identifier = {}
+    for etf in etf_list:
+        try:
+            ter_by_identifier[get_combined_name_and_isin(etf.get_name(), etf.get_isin())] = etf.get_ter()
+        except (KeyError, TypeError, ValueError):
+            print("Could not read the TER of ETF {}".format(etf.get_name()))
+
+    ters = np.array([ter_by_identifier.get(identifier, 0.0) for identifier in identifiers], dtype=np.float64)
+    return pandas.Series(ters, index=identifiers)
+
+
+def save_prices_snapshot(etf_list, prices_df, path):
+    """ Writes the prices as a dense float64 date x ETF matrix next to its date and identifier indexes, together with the
+        ETF metadata, so the optimizer can start without MongoDB. The matrix is stored column-major so that it can be
+        memory-mapped straight into the layout pandas uses."""
+
+    start = default_timer()
+
+    tmp_path = path + ".tmp"
+    old_path = path + ".old"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    np.save(os.path.join(tmp_path, SNAPSHOT_PRICES_FILE), np.asfortranarray(prices_df.to_numpy(dtype=np.float64)))
+    np.save(os.path.join(tmp_path, SNAPSHOT_DATES_FILE), prices_df.index.to_numpy().astype("datetime64[D]"))
+
+    with open(os.path.join(tmp_path, SNAPSHOT_IDENTIFIERS_FILE), "w") as f:
+        json.dump(list(prices_df.columns), f)
+
+    etfs_as_json = []
+    for etf in etf_list:
+        etfs_as_json.append({"_id": str(etf.get_id()), "data": etf.get_data(), "daysWithData": etf.get_days_with_data()})
+
+    with open(os.path.join(tmp_path, SNAPSHOT_ETFS_FILE), "w") as f:
+        json.dump(etfs_as_json, f)
+
+    # Readers that still have the previous snapshot mapped keep their pages, the files are only unlinked
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+    end = default_timer()
+    print("Time to save prices snapshot {}".format(end - start))
+
+
+def prices_snapshot_exists(path):
+    return os.path.exists(os.path.join(path, SNAPSHOT_PRICES_FILE))
+
+
+def load_prices_snapshot(path):
+    """ The prices matrix is memory-mapped read-only, so every process that loads the same snapshot shares its pages."""
+
+    start = default_timer()
+
+    matrix = np.load(os.path.join(path, SNAPSHOT_PRICES_FILE), mmap_mode="r")
+    dates = np.load(os.path.join(path, SNAPSHOT_DATES_FILE))
+
+    with open(os.path.join(path, SNAPSHOT_IDENTIFIERS_FILE)) as f:
+        identifiers = json.load(f)
+
+    with open(os.path.join(path, SNAPSHOT_ETFS_FILE)) as f:
+        etf_list = [ETF(d["_id"], d["data"], [], d["daysWithData"]) for d in json.load(f)]
+
+    prices_df = pandas.DataFrame(matrix, index=dates.astype(str).astype(object), columns=identifiers, copy=False)
+
+    end = default_timer()
+    print("Time to load prices snapshot {}".format(end - start))
+
+    return etf_list, prices_df
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,12 @@
 import requests
-import eikon
-import pandas
 import datetime
-from mongoDB import get_etf_list, save_etf_list, update_etf_historical_data, TEST_DB_NAME
+from mongoDB import get_etf_list, save_etf_list, BulkWriter, TEST_DB_NAME
 from ETF import *
+from fetcher import EikonDataProvider, FetchScheduler
 import os
+import sys
 from timeit import default_timer as timer
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import math
 
 EIKON_APP_KEY = os.environ.get('EIKON_APP_KEY', "")
@@ -14,22 +14,32 @@ JUSTETF_URL = os.environ.get('JUSTETF_URL', "")
 
 START_DATE = "2000-01-01"
 
-ETFS_PER_ASYNC_REQUEST = int(os.environ.get('ETFS_PER_ASYNC_REQUEST', 1))
+EIKON_CONCURRENT_REQUESTS = int(os.environ.get('EIKON_CONCURRENT_REQUESTS', 4))
+EIKON_REQUESTS_PER_SECOND = float(os.environ.get('EIKON_REQUESTS_PER_SECOND', 5))
+EIKON_MAX_RETRIES = int(os.environ.get('EIKON_MAX_RETRIES', 4))
 
 
 def main():
+    scheduler = FetchScheduler(EikonDataProvider(EIKON_APP_KEY), EIKON_CONCURRENT_REQUESTS, EIKON_REQUESTS_PER_SECOND,
+                               EIKON_MAX_RETRIES)
+
     etf_list = get_etf_list(TEST_DB_NAME)
 
     if len(etf_list) == 0:
         etf_data = get_etf_data()
         etf_list = get_etf_list_from_json(etf_data)
-        get_ric_rodes(etf_list)
+        get_ric_rodes(etf_list, scheduler)
         save_etf_list(etf_list, TEST_DB_NAME)
         etf_list = get_etf_list(TEST_DB_NAME)
 
     print("Found " + str(len(etf_list)) + " ETFs")
 
-    get_historical_data(etf_list)
+    if len(sys.argv) > 1 and sys.argv[1] == "update":
+        update_historical_data(etf_list, scheduler)
+    else:
+        get_historical_data(etf_list, scheduler)
+
+    scheduler.shutdown()
 
 
 def get_etf_data():
@@ -60,81 +70,75 @@ def get_etf_data():
     return json_data["data"]
 
 
-def get_ric_rodes(etf_list):
+def get_ric_rodes(etf_list, scheduler):
     print()
     print("Get RIC codes from ISIN")
 
-    eikon.set_app_key(EIKON_APP_KEY)
-
     isin_codes = []
 
     for etf in etf_list:
         isin_codes.append(etf.get_isin())
 
-    ric_codes = eikon.get_symbology(isin_codes, from_symbol_type="ISIN", to_symbol_type="RIC", bestMatch=False)
+    rics_by_etf = scheduler.get_rics(isin_codes)
 
-    i = 0
-    for index, row in ric_codes.iterrows():
-        rics = row["RICs"]
-        etf_list[i].set_rics(rics)
-        i += 1
+    for etf, rics in zip(etf_list, rics_by_etf):
+        etf.set_rics(rics)
 
 
-def get_historical_data(etf_list):
+def get_historical_data(etf_list, scheduler):
+    """ Every ETF is handled by its own task and written to mongo as soon as it's done. The tasks only wait on the
+        scheduler, which keeps the same number of requests to Eikon in flight until the whole list is fetched."""
     print()
     print("Get historical data for ETFs")
 
-    eikon.set_app_key(EIKON_APP_KEY)
-
-    n_etfs = len(etf_list)
-    for i in range(0, n_etfs, ETFS_PER_ASYNC_REQUEST):
-
-        if n_etfs < i + ETFS_PER_ASYNC_REQUEST:
-            until = n_etfs
-        else:
-            until = i + ETFS_PER_ASYNC_REQUEST
-
-        etfs = etf_list[i:until]
-        start = timer()
-        with ThreadPoolExecutor(max_workers=ETFS_PER_ASYNC_REQUEST) as executor:
-            results = executor.map(get_etf_historical_data, etfs)
-        added = sum(results)
-        end = timer()
-        print("Took {}s to get etf data for {} ETFs from eikon".format(end - start, added))
+    start = timer()
+    added = 0
+    # A task fetches the RICs of its ETF and their pages one request at a time, so it takes as many tasks as requests in
+    # flight to keep the scheduler busy
+    with ThreadPoolExecutor(max_workers=EIKON_CONCURRENT_REQUESTS) as executor, BulkWriter(TEST_DB_NAME) as writer:
+        futures = {executor.submit(get_etf_historical_data, etf, scheduler): etf for etf in etf_list}
 
-        if added > 0:
-            start = timer()
-            for etf in etfs:
-                update_etf_historical_data(etf, TEST_DB_NAME)
-            end = timer()
-            print("Took {}s to get write etf data to mongodb. {}-{}".format(end - start, i, until))
+        for future in as_completed(futures):
+            if future.result() > 0:
+                writer.update_etf_historical_data(futures[future])
+                added += 1
+    end = timer()
+    print("Took {}s to get etf data for {} ETFs from eikon".format(end - start, added))
 
 
-def get_etf_historical_data(etf):
+def get_etf_historical_data(etf, scheduler):
     start = timer()
-    if etf.get_no_data_found() or len(etf.get_historical_data()) > 0:
+    if etf.get_no_data_found() or etf.get_days_with_data() > 0:
         return 0
 
-    rics = etf.get_rics()
+    historical_data, ric, ignored = find_etf_historical_data(etf, scheduler)
+
+    if len(historical_data) == 0:
+        print("Could not get any results for this ETF {}".format(etf.get_name()))
+        etf.set_no_data_found()
+        etf.set_historical_data([])
+        return 1
+    else:
+        end = timer()
+        print("Got {} days of data for ETF {} from {}, took {} and ignored {} results".format(
+            len(historical_data), etf.get_name(), ric, end - start, ignored))
+        etf.set_historical_data(historical_data)
+        etf.set_historical_data_ric(ric)
+        return 1
+
 
-    rics_with_data = get_rics_with_data(rics)
+def find_etf_historical_data(etf, scheduler):
+    """ Returns the longest history of the first 3 RICs of the ETF that have data, the RIC it came from and how many
+        RICs only had NaNs."""
+    rics_with_data = scheduler.get_rics_with_data(etf.get_rics())
 
     historical_data = []
+    historical_data_ric = None
     found = 3
     ignored = 0
     for ric in rics_with_data:
         try:
-            historical_data_tmp = []
-            start_date = START_DATE
-            end_date = datetime.datetime.now()
-            while len(historical_data_tmp) % 3000 == 0 and is_date_in_the_past(start_date):
-                data = get_data_by_ric_from_start_date(ric, start_date, end_date)
-
-                if len(data) == 0:
-                    break
-
-                historical_data_tmp = data + historical_data_tmp
-                end_date = get_previous_day(data[0]["date"])
+            historical_data_tmp = scheduler.get_closes(ric, START_DATE, datetime.datetime.now())
 
             if has_only_nans(historical_data_tmp):
                 ignored += 1
@@ -144,6 +148,7 @@ def get_etf_historical_data(etf):
 
             if len(historical_data_tmp) > len(historical_data):
                 historical_data = historical_data_tmp
+                historical_data_ric = ric
 
             if found == 0:
                 break
@@ -151,16 +156,68 @@ def get_etf_historical_data(etf):
         except Exception as e:
             print("Could not get any data for ric {}".format(ric))
 
-    if len(historical_data) == 0:
-        print("Could not get any results for this ETF {}".format(etf.get_name()))
-        etf.set_no_data_found()
-        etf.set_historical_data([])
-        return 1
-    else:
-        end = timer()
-        print("Got {} days of data for ETF {}, took {} and ignored {} results".format(len(historical_data), etf.get_name(), end - start, ignored))
+    return historical_data, historical_data_ric, ignored
+
+
+def update_historical_data(etf_list, scheduler):
+    """ Appends the days since the last recorded close of every ETF, instead of getting the whole history again."""
+    print()
+    print("Update historical data for ETFs")
+
+    start = timer()
+    updated = 0
+    with ThreadPoolExecutor(max_workers=EIKON_CONCURRENT_REQUESTS) as executor, BulkWriter(TEST_DB_NAME) as writer:
+        futures = {executor.submit(get_new_etf_historical_data, etf, scheduler): etf for etf in etf_list}
+
+        for future in as_completed(futures):
+            etf = futures[future]
+            try:
+                new_historical_data, whole_history = future.result()
+            except Exception as e:
+                print("Could not update data for ETF {}: {}".format(etf.get_name(), e))
+                continue
+
+            if len(new_historical_data) == 0:
+                continue
+
+            if whole_history:
+                writer.update_etf_historical_data(etf)
+            else:
+                writer.append_etf_historical_data(etf, new_historical_data)
+            updated += 1
+    end = timer()
+    print("Took {}s to update etf data for {} ETFs".format(end - start, updated))
+
+
+def get_new_etf_historical_data(etf, scheduler):
+    """ Returns the new days and whether they are the whole history of the ETF rather than the days after its last one.
+        The new days come from the RIC the history was fetched from, other listings of the ETF can have other prices.
+        ETFs stored before their RIC was recorded get their whole history again, which records it."""
+    if etf.get_no_data_found() or etf.get_days_with_data() == 0:
+        return [], False
+
+    ric = etf.get_historical_data_ric()
+    if ric is None:
+        historical_data, ric, _ = find_etf_historical_data(etf, scheduler)
+        if len(historical_data) == 0:
+            return [], False
+
         etf.set_historical_data(historical_data)
-        return 1
+        etf.set_historical_data_ric(ric)
+        return historical_data, True
+
+    last_date = etf.get_last_date()
+    start_date = get_next_day(last_date)
+    if not is_date_in_the_past(start_date):
+        return [], False
+
+    data = scheduler.get_closes(ric, start_date, datetime.datetime.now())
+    new_historical_data = [d for d in data if d["date"] > last_date]
+
+    if has_only_nans(new_historical_data):
+        return [], False
+
+    return new_historical_data, False
 
 
 def has_only_nans(data):
@@ -183,8 +240,8 @@ def is_lacking_data(data):
     return len(data) < (days_since * 0.66)
 
 
-def get_previous_day(date_string):
-    date = datetime.datetime.strptime(date_string, "%Y-%m-%d") - datetime.timedelta(days=1)
+def get_next_day(date_string):
+    date = datetime.datetime.strptime(date_string, "%Y-%m-%d") + datetime.timedelta(days=1)
     return date.strftime('%Y-%m-%d')
 
 
@@ -192,27 +249,5 @@ def is_date_in_the_past(date_string):
     return datetime.datetime.strptime(date_string, "%Y-%m-%d").date() < datetime.datetime.now().date()
 
 
-def get_data_by_ric_from_start_date(ric, start_date, end_date):
-    result = eikon.get_timeseries(ric, start_date=start_date, end_date=end_date, fields="CLOSE")
-
-    data = []
-    for index, row in result.iterrows():
-        close = row["CLOSE"]
-        if pandas.isna(close):
-            close = float("nan")
-        data.append({"date": str(index.date()), "close": close})
-
-    return data
-
-
-def get_rics_with_data(rics):
-    if len(rics) == 0:
-        return []
-
-    result = eikon.get_timeseries(rics, start_date=-datetime.timedelta(days=30), end_date=datetime.datetime.now(), fields="CLOSE")
-
-    return list(result)
-
-
 if __name__ == "__main__":
     main()
@@ -0,0 +1,119 @@
+import numpy as np
+import pandas
+
+FREQUENCY = 252
+
+
+class RollingCovariance:
+    """ Annualised sample covariance of daily returns over a window of the prices data frame, computed like pypfopt's
+        sample_cov with pairwise complete observations. The window keeps the counts, sums and cross products of the
+        returns inside it, so moving it forward only adds the new days and removes the ones that left, instead of going
+        over the whole history again for every backtrading rebalance.
+
+        Only the ETFs that were asked for are tracked. An ETF is added the first time a window of prices has it, with
+        its products against the ones already tracked over the current window, so the matrices are as big as the
+        columns the optimizations use rather than every ETF that matches the filters."""
+
+    def __init__(self, prices_df):
+        self.prices_df = prices_df
+        self.rows_by_date = {date: row for row, date in enumerate(prices_df.index)}
+        self.columns_by_identifier = {}
+
+        # The returns of day i are stored in row i, the first day has none
+        self.present = np.zeros((len(prices_df.index), 0))
+        self.returns = np.zeros((len(prices_df.index), 0))
+
+        self.start = 0
+        self.end = 0
+        self.counts = np.zeros((0, 0))
+        self.sums = np.zeros((0, 0))
+        self.cross_products = np.zeros((0, 0))
+
+    def get_covariance(self, prices):
+        """ Covariance of the returns of the given prices, which have to be a window of the prices data frame."""
+        from pypfopt import risk_models
+
+        self.move_window(self.rows_by_date[prices.index[0]] + 1, self.rows_by_date[prices.index[-1]] + 1)
+        self.add_columns(prices.columns)
+
+        columns = [self.columns_by_identifier[identifier] for identifier in prices.columns]
+        selection = np.ix_(columns, columns)
+
+        counts = self.counts[selection]
+        sums = self.sums[selection]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cov = (self.cross_products[selection] - sums * sums.T / counts) / (counts - 1)
+        cov[counts < 2] = np.nan
+
+        cov = pandas.DataFrame(cov * FREQUENCY, index=prices.columns, columns=prices.columns)
+        return risk_models.fix_nonpositive_semidefinite(cov)
+
+    def add_columns(self, identifiers):
+        """ Starts tracking the identifiers that aren't yet, with their statistics over the current window."""
+        new_identifiers = [identifier for identifier in dict.fromkeys(identifiers)
+                           if identifier not in self.columns_by_identifier]
+        if len(new_identifiers) == 0:
+            return
+
+        present, returns = get_present_and_returns(self.prices_df[new_identifiers].to_numpy(dtype=np.float64))
+
+        for identifier in new_identifiers:
+            self.columns_by_identifier[identifier] = len(self.columns_by_identifier)
+        self.present = np.hstack((self.present, present))
+        self.returns = np.hstack((self.returns, returns))
+
+        window_present = self.present[self.start:self.end]
+        window_returns = self.returns[self.start:self.end]
+        new_present = present[self.start:self.end]
+        new_returns = returns[self.start:self.end]
+
+        counts = window_present.T @ new_present
+        self.counts = add_to_matrix(self.counts, counts, counts.T)
+        self.sums = add_to_matrix(self.sums, window_returns.T @ new_present, new_returns.T @ window_present)
+        cross_products = window_returns.T @ new_returns
+        self.cross_products = add_to_matrix(self.cross_products, cross_products, cross_products.T)
+
+    def move_window(self, start, end):
+        """ Moves the window to the returns of rows [start, end). Windows that go back in time are rebuilt."""
+        if start < self.start or end < self.end or start >= self.end:
+            self.counts[:] = 0
+            self.sums[:] = 0
+            self.cross_products[:] = 0
+            self.start = self.end = start
+
+        self.update(self.end, end, 1)
+        self.update(self.start, start, -1)
+
+        self.start = start
+        self.end = end
+
+    def update(self, first_row, last_row, sign):
+        if last_row <= first_row:
+            return
+
+        present = self.present[first_row:last_row]
+        returns = self.returns[first_row:last_row]
+
+        self.counts += sign * (present.T @ present)
+        self.sums += sign * (returns.T @ present)
+        self.cross_products += sign * (returns.T @ returns)
+
+
+def get_present_and_returns(prices):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        returns = prices[1:] / prices[:-1] - 1
+
+    present = np.vstack((np.zeros((1, prices.shape[1])), ~np.isnan(returns))).astype(np.float64)
+    returns = np.vstack((np.zeros((1, prices.shape[1])), np.nan_to_num(returns, nan=0.0)))
+    return present, returns
+
+
+def add_to_matrix(matrix, new_columns, new_rows):
+    """ Grows the matrix with the columns of the new identifiers against all of them and the matching rows."""
+    size = len(matrix)
+    grown = np.empty((len(new_columns), len(new_columns)))
+    grown[:size, :size] = matrix
+    grown[:, size:] = new_columns
+    grown[size:, :] = new_rows
+    return grown
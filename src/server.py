@@ -1,17 +1,89 @@
+import startup
 import flask
 from flask_cors import CORS
 from waitress import serve
 import optimizer
-from mongoDB import get_etf_list_with_historical_data, PRODUCTION_DB_NAME
 import backtrader
-import parameters
+import dataset
+import jobs
+import frontierImages
+import solverPool
+import timing
+from encodedResponses import EncodedResponseCache
+from timeit import default_timer
+import math
+import os
+
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', "")
+
+BACKTRADE_JOB_WORKERS = int(os.environ.get('BACKTRADE_JOB_WORKERS', 2))
+MAX_ACTIVE_BACKTRADE_JOBS = int(os.environ.get('MAX_ACTIVE_BACKTRADE_JOBS', 10))
+BACKTRADE_JOB_RESULT_TTL_IN_SECONDS = int(os.environ.get('BACKTRADE_JOB_RESULT_TTL_IN_SECONDS', 3600))
+
+# Requests waiting for a solver worker hold a thread, so there are always threads left for the other endpoints
+SERVER_THREADS = int(os.environ.get('SERVER_THREADS', solverPool.SOLVER_WORKERS + solverPool.SOLVER_QUEUE_SIZE + 4))
+RETRY_AFTER_IN_SECONDS = 1
+
+# The only endpoints that answer before the dataset is loaded
+STARTUP_ENDPOINTS = ["get_health", "get_readiness", "get_metrics"]
 
 app = flask.Flask(__name__)
 CORS(app)
 
-full_etf_list = get_etf_list_with_historical_data(PRODUCTION_DB_NAME)
-parameters = parameters.get_parameters(full_etf_list)
-prices_df = optimizer.get_complete_prices_data_frame(full_etf_list)
+# The dataset is loaded after the server starts listening, requests that need it get a 503 until it's ready
+server_startup = startup.Startup()
+
+backtrade_jobs = jobs.JobRunner(BACKTRADE_JOB_WORKERS, MAX_ACTIVE_BACKTRADE_JOBS, BACKTRADE_JOB_RESULT_TTL_IN_SECONDS)
+
+# Optimizations and backtrades run on worker processes, or on the request threads with SOLVER_WORKERS=0
+solver_pool = None
+if solverPool.SOLVER_WORKERS > 0:
+    solver_pool = solverPool.SolverPool(solverPool.SOLVER_WORKERS, solverPool.SOLVER_QUEUE_SIZE,
+                                        solverPool.SOLVER_DEADLINE_IN_SECONDS)
+
+# Responses that only change with the dataset are serialized once per dataset version
+encoded_responses = EncodedResponseCache()
+
+
+@app.before_request
+def start_request_timer():
+    flask.g.request_start = default_timer()
+
+
+@app.before_request
+def reject_until_ready():
+    if not server_startup.is_ready() and flask.request.endpoint not in STARTUP_ENDPOINTS:
+        return {"error": "The optimizer is starting, try again later."}, 503, \
+            {"Retry-After": str(RETRY_AFTER_IN_SECONDS)}
+
+
+@app.after_request
+def observe_request_time(response):
+    start = flask.g.get("request_start")
+    if start is not None:
+        endpoint = flask.request.url_rule.rule if flask.request.url_rule is not None else "unmatched"
+        timing.request_histogram.observe(default_timer() - start, endpoint, flask.request.method,
+                                         response.status_code)
+    return response
+
+
+@app.route('/healthz', methods=["GET"])
+def get_health():
+    """ Fails only if the startup failed, a server that's still starting is alive."""
+    return server_startup.to_json(), 500 if server_startup.has_failed() else 200
+
+
+@app.route('/readyz', methods=["GET"])
+def get_readiness():
+    return server_startup.to_json(), 200 if server_startup.is_ready() else 503
+
+
+@app.route('/metrics', methods=["GET"])
+def get_metrics():
+    metrics = timing.get_metrics()
+    if solver_pool is not None:
+        metrics += solver_pool.get_metrics()
+    return flask.Response(metrics, content_type="text/plain; version=0.0.4; charset=utf-8")
 
 
 @app.route('/api/optimize', methods=["POST"])
@@ -20,7 +92,28 @@ def optimize():
         body = flask.request.json
         optimizer_parameters = body.get("optimizerParameters", {})
         etf_filters = body.get("etfFilters", {})
-        return optimizer.optimize(full_etf_list, prices_df, optimizer_parameters, etf_filters)
+        optimize_with_result_cache = with_timings(body, optimizer.optimize_with_result_cache)
+        return optimize_with_result_cache(dataset.get_dataset(), optimizer_parameters, etf_filters, solver_pool)
+    except solverPool.Overloaded as e:
+        return get_overloaded_response(e)
+    except Exception as e:
+        print("Exception: ", e)
+        return {"error": str(e)}, 400
+
+
+@app.route('/api/optimizeBatch', methods=["POST"])
+def optimize_batch():
+    try:
+        body = flask.request.json
+        optimizer_parameters_list = body.get("optimizerParameters", [])
+        etf_filters = body.get("etfFilters", {})
+        if not isinstance(optimizer_parameters_list, list):
+            raise Exception("optimizerParameters must be a list of the parameters of every optimization.")
+
+        return with_timings(body, optimizer.optimize_batch)(dataset.get_dataset(), optimizer_parameters_list,
+                                                            etf_filters, solver_pool)
+    except solverPool.Overloaded as e:
+        return get_overloaded_response(e)
     except Exception as e:
         print("Exception: ", e)
         return {"error": str(e)}, 400
@@ -33,19 +126,82 @@ def backtrade():
         optimizer_parameters = body.get("optimizerParameters", {})
         etf_filters = body.get("etfFilters", {})
         backtrade_parameters = body.get("backtradeParameters", {})
-        return backtrader.backtrade(full_etf_list, prices_df, optimizer_parameters, etf_filters, backtrade_parameters)
+        return with_timings(body, run_on_solver_pool)(backtrader.backtrade, dataset.get_dataset(), optimizer_parameters,
+                                                      etf_filters, backtrade_parameters)
+    except solverPool.Overloaded as e:
+        return get_overloaded_response(e)
     except Exception as e:
         print("Exception: ", e)
         return {"error": str(e)}, 400
 
 
+@app.route('/api/backtrade/jobs', methods=["POST"])
+def submit_backtrade_job():
+    try:
+        body = flask.request.json
+        optimizer_parameters = body.get("optimizerParameters", {})
+        etf_filters = body.get("etfFilters", {})
+        backtrade_parameters = body.get("backtradeParameters", {})
+        job = backtrade_jobs.submit(with_timings(body, run_backtrade_job), dataset.get_dataset(),
+                                    optimizer_parameters, etf_filters, backtrade_parameters)
+        return job.to_json(), 202
+    except jobs.TooManyJobs as e:
+        return {"error": str(e)}, 429
+    except Exception as e:
+        print("Exception: ", e)
+        return {"error": str(e)}, 400
+
+
+@app.route('/api/backtrade/jobs/<job_id>', methods=["GET"])
+def get_backtrade_job(job_id):
+    job = backtrade_jobs.get(job_id)
+    if job is None:
+        return {"error": "No backtrade job with id {}".format(job_id)}, 404
+    return job.to_json()
+
+
+@app.route('/api/backtrade/jobs/<job_id>/result', methods=["GET"])
+def get_backtrade_job_result(job_id):
+    job = backtrade_jobs.get(job_id)
+    if job is None:
+        return {"error": "No backtrade job with id {}".format(job_id)}, 404
+    if job.status == jobs.FAILED:
+        return {"error": job.error}, 400
+    if job.status == jobs.CANCELLED:
+        return {"error": "Backtrade job {} was cancelled and has no result".format(job_id)}, 410
+    if job.status != jobs.DONE:
+        return job.to_json(), 409
+    return job.result
+
+
+@app.route('/api/backtrade/jobs/<job_id>', methods=["DELETE"])
+def cancel_backtrade_job(job_id):
+    job = backtrade_jobs.cancel(job_id)
+    if job is None:
+        return {"error": "No backtrade job with id {}".format(job_id)}, 404
+    return job.to_json()
+
+
+@app.route('/api/efficientFrontierImage/<image_id>', methods=["GET"])
+def get_efficient_frontier_image(image_id):
+    image = frontierImages.get_efficient_frontier_image(image_id)
+    if image is None:
+        return {"error": "Efficient frontier image not found, optimize again to get a new one"}, 404
+
+    response = flask.Response(image, mimetype="image/png")
+    # The id is the hash of what's drawn, so the image behind it never changes
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
 @app.route('/api/etfsMatchingFilters', methods=["POST"])
 def get_etfs_matching_filters():
     try:
         body = flask.request.json
         etf_filters = body.get("etfFilters", {})
-        filtered_etfs = optimizer.filter_etfs_using_filters(full_etf_list, etf_filters)
-        return {"etfsMatchingFilters": len(filtered_etfs), "totalETFs": len(full_etf_list)}
+        current = dataset.get_dataset()
+        etfs_matching_filters = optimizer.count_etfs_matching_filters(current.etf_index, etf_filters)
+        return {"etfsMatchingFilters": etfs_matching_filters, "totalETFs": len(current.etf_list)}
     except Exception as e:
         print("Exception: ", e)
         return {"error": str(e)}, 400
@@ -54,7 +210,9 @@ def get_etfs_matching_filters():
 @app.route('/api/parameters', methods=["GET"])
 def get_parameters():
     try:
-        return parameters
+        current = dataset.get_dataset()
+        response = encoded_responses.get("parameters", current.version, lambda: current.parameters)
+        return response.to_response(flask.request)
     except Exception as e:
         print("Exception: ", e)
         return {"error": str(e)}, 400
@@ -63,16 +221,94 @@ def get_parameters():
 @app.route('/etfList', methods=["GET"])
 def get_etf_list():
     try:
-        etf_json_list = []
-        for etf in full_etf_list:
-            etf_as_json = etf.get_data()
-            etf_as_json["daysWithData"] = len(etf.get_historical_data())
-            etf_json_list.append(etf_as_json)
-        return {"etfList": etf_json_list}
+        current = dataset.get_dataset()
+        response = encoded_responses.get("etfList", current.version, lambda: get_etf_list_body(current.etf_list))
+        return response.to_response(flask.request)
     except Exception as e:
         print("Exception: ", e)
         return {"error": str(e)}, 400
 
 
+def get_etf_list_body(etf_list):
+    etf_json_list = []
+    for etf in etf_list:
+        etf_as_json = dict(etf.get_data())
+        etf_as_json["daysWithData"] = etf.get_days_with_data()
+        etf_json_list.append(etf_as_json)
+    return {"etfList": etf_json_list}
+
+
+@app.route('/api/admin/updatePrices', methods=["POST"])
+def update_prices():
+    if not is_admin_request():
+        return {"error": "Not authorized"}, 403
+    try:
+        current, updated_etfs = dataset.update_dataset()
+        return {"updatedETFs": updated_etfs, "totalETFs": len(current.etf_list), "version": current.version,
+                "lastDate": current.prices_df.index[-1]}
+    except Exception as e:
+        print("Exception: ", e)
+        return {"error": str(e)}, 400
+
+
+@app.route('/api/admin/cacheStats', methods=["GET"])
+def get_cache_stats():
+    if not is_admin_request():
+        return {"error": "Not authorized"}, 403
+    covariance_cache_stats = optimizer.covariance_cache.get_stats() if solver_pool is None else \
+        solver_pool.get_covariance_cache_stats()
+    return {"covarianceCache": covariance_cache_stats, "resultCache": optimizer.result_cache.get_stats()}
+
+
+def with_timings(body, function):
+    """ If the request asks for it with "timings": true, the function returned adds the seconds spent in every stage to
+        the result of the function given."""
+    if not body.get("timings", False):
+        return function
+
+    def timed(*args, **kwargs):
+        with timing.collect_timings() as timings:
+            result = function(*args, **kwargs)
+        result["timings"] = timings.to_json()
+        return result
+
+    return timed
+
+
+def get_startup_phases():
+    phases = [("dataset", dataset.load_dataset)]
+    if solver_pool is not None:
+        phases.append(("solverWorkers", lambda: solver_pool.start(dataset.get_dataset())))
+    return phases + [("warmUpImports", startup.warm_up_imports)]
+
+
+def run_on_solver_pool(function, current, *args):
+    if solver_pool is None:
+        return function(current, *args)
+    return solver_pool.run(current, function, *args)
+
+
+def run_backtrade_job(current, optimizer_parameters, etf_filters, backtrade_parameters, progress_callback):
+    """ Jobs report their progress and can be cancelled while they run in a solver worker. They aren't bound by the
+        deadline of the requests, a backtrade takes as long as it takes."""
+    if solver_pool is None:
+        return backtrader.backtrade(current, optimizer_parameters, etf_filters, backtrade_parameters, progress_callback)
+    return solver_pool.run(current, backtrader.backtrade, optimizer_parameters, etf_filters, backtrade_parameters,
+                           progress_callback=progress_callback, deadline_in_seconds=math.inf)
+
+
+def get_overloaded_response(e):
+    """ 429 when the solver pool is full, 503 when the request couldn't be run in time. Both can be retried."""
+    status = 429 if isinstance(e, solverPool.PoolFull) else 503
+    return {"error": str(e)}, status, {"Retry-After": str(RETRY_AFTER_IN_SECONDS)}
+
+
+def is_admin_request():
+    return ADMIN_TOKEN != "" and flask.request.headers.get("X-Admin-Token") == ADMIN_TOKEN
+
+
 if __name__ == '__main__':
-    serve(app, host="0.0.0.0")
+    # Only the server starts, the solver workers import this module too
+    server_startup.start(get_startup_phases())
+    print("Listening {} after the server started".format(startup.get_seconds_since_start()))
+    serve(app, host="0.0.0.0", threads=SERVER_THREADS)
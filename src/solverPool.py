@@ -0,0 +1,332 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from cache import LRUCache
+from dataset import Dataset, get_dataset
+import backtrader
+import optimizer
+import prices
+import startup
+import timing
+import concurrent.futures
+import functools
+import multiprocessing
+import os
+import threading
+import time
+
+SOLVER_WORKERS = int(os.environ.get('SOLVER_WORKERS', os.cpu_count() or 1))
+SOLVER_QUEUE_SIZE = int(os.environ.get('SOLVER_QUEUE_SIZE', 8))
+SOLVER_DEADLINE_IN_SECONDS = int(os.environ.get('SOLVER_DEADLINE_IN_SECONDS', 300))
+PROGRESS_INTERVAL_IN_SECONDS = 0.5
+
+# Workers are forked from a forkserver process instead of from the server, which has its threads and their locks. The
+# forkserver imports these once, so the workers start with them
+WORKER_PRELOAD_MODULES = ["solverPool", "backtrader"] + startup.WARM_UP_MODULES
+
+_context = multiprocessing.get_context("forkserver")
+_context.set_forkserver_preload(WORKER_PRELOAD_MODULES)
+
+# Dataset of a worker process, the one the pool was created for
+_worker_dataset = None
+# Shared by the workers of a pool, the tasks that start the pool wait on it until every worker has one
+_worker_start_barrier = None
+WORKER_START_TIMEOUT_IN_SECONDS = 300
+
+
+class Overloaded(Exception):
+    """ The request wasn't run, it can be retried later."""
+    pass
+
+
+class PoolFull(Overloaded):
+    pass
+
+
+class PoolUnavailable(Overloaded):
+    pass
+
+
+class DeadlineExceeded(Overloaded):
+    pass
+
+
+class TaskStopped(Exception):
+    """ Raised in a worker by a task that was asked to stop through its progress callback."""
+    pass
+
+
+class TaskProgress:
+    """ Progress of a task running in a worker, shared through a manager process. The task sets the steps it's done and
+        the thread waiting for it passes them on to the callback. When the callback raises, the task is asked to stop
+        and the exception is kept to be raised to the waiting thread."""
+
+    def __init__(self, shared, callback):
+        self.shared = shared
+        self.callback = callback
+        self.error = None
+
+    def pass_on(self):
+        """ Returns whether the task was asked to stop."""
+        if self.error is None:
+            try:
+                self.callback(*self.shared.get("steps", (0, None)))
+            except Exception as e:
+                self.error = e
+                self.shared["stop"] = True
+        return self.error is not None
+
+
+class SolverPool:
+    """ Runs CPU-bound work on a fixed number of worker processes, so it doesn't hold the GIL of the threads serving
+        requests. The workers load the dataset from its prices snapshot, which is memory-mapped, so its pages are
+        shared with the server and every other worker. A dataset without a snapshot is pickled to every worker. When
+        the dataset is updated, the workers are replaced by ones started with the new dataset. Each worker has its own
+        covariance cache, with an even part of the memory cap.
+
+        At most workers + max_queued tasks are accepted at once, the ones above that are rejected right away instead of
+        waiting. Every task has a deadline, the caller stops waiting when it passes and a task still queued by then
+        isn't run. A task that's already running can't be stopped and keeps its worker until it's done."""
+
+    def __init__(self, workers, max_queued, deadline_in_seconds):
+        self.workers = workers
+        self.max_tasks = workers + max_queued
+        self.deadline_in_seconds = deadline_in_seconds
+        self.executor = None
+        self.dataset = None
+        self.manager = None
+        self.tasks = 0
+        self.rejected = 0
+        self.deadlines_exceeded = 0
+        self.covariance_cache_stats_by_worker = {}
+        self.lock = threading.Lock()
+
+    def start(self, dataset):
+        """ Starts the workers for the dataset, so the first requests don't wait for them."""
+        with self.lock:
+            executor = self.get_executor(dataset)
+
+        for future in [executor.submit(start_worker) for _ in range(self.workers)]:
+            self.set_covariance_cache_stats(executor, future.result())
+
+    def run(self, dataset, function, *args, progress_callback=None, deadline_in_seconds=None):
+        """ Returns function(dataset, *args), run in a worker. The spans of the worker are added to the stage histogram
+            and to the timings of the request.
+
+            With a progress callback the function is given one too, and the steps it reports are passed on to the
+            callback from this thread. If the callback raises, the function stops at its next step and the exception is
+            raised here."""
+        progress = None
+        if progress_callback is not None:
+            progress = TaskProgress(self.get_manager().dict(), progress_callback)
+        return self.run_all(dataset, function, [args], deadline_in_seconds, progress)[0]
+
+    def run_all(self, dataset, function, args_list, deadline_in_seconds=None, progress=None):
+        """ Returns function(dataset, *args) for every args of the list, run in as many workers at once. The tasks are
+            accepted all together or not at all, and they share the deadline, the one of the pool unless another is
+            given."""
+        if deadline_in_seconds is None:
+            deadline_in_seconds = self.deadline_in_seconds
+        deadline = time.time() + deadline_in_seconds
+        executor, futures = self.submit(dataset, function, args_list, deadline,
+                                        progress.shared if progress is not None else None)
+
+        try:
+            with timing.span("solverWait"):
+                results = wait_for_results(futures, deadline, progress)
+        except concurrent.futures.TimeoutError:
+            self.count_deadline_exceeded()
+            raise DeadlineExceeded("The request took longer than {} seconds and was stopped, try again later."
+                                   .format(deadline_in_seconds))
+        except TaskStopped:
+            raise progress.error from None
+        except DeadlineExceeded:
+            self.count_deadline_exceeded()
+            raise
+        except BrokenProcessPool:
+            self.remove_executor(executor)
+            raise PoolUnavailable("A solver worker stopped unexpectedly, try again.")
+        finally:
+            # The tasks of a request that failed aren't run if they're still queued
+            for future in futures:
+                future.cancel()
+
+        for result, seconds_by_span, covariance_cache_stats in results:
+            timing.add_timings(seconds_by_span)
+            self.set_covariance_cache_stats(executor, covariance_cache_stats)
+        return [result for result, seconds_by_span, covariance_cache_stats in results]
+
+    def submit(self, dataset, function, args_list, deadline, shared_progress=None):
+        with self.lock:
+            if self.tasks + len(args_list) > self.max_tasks:
+                self.rejected += 1
+                raise PoolFull("The optimizer is busy with {} requests, try again later.".format(self.tasks))
+
+            executor = self.get_executor(dataset)
+            self.tasks += len(args_list)
+
+        futures = []
+        try:
+            for args in args_list:
+                future = executor.submit(run_task, function, args, dataset.version, deadline, shared_progress)
+                # Also called when the task is cancelled before running
+                future.add_done_callback(self.task_done)
+                futures.append(future)
+        except BrokenProcessPool:
+            self.task_done(None, len(args_list) - len(futures))
+            self.remove_executor(executor)
+            raise PoolUnavailable("A solver worker stopped unexpectedly, try again.")
+
+        return executor, futures
+
+    def get_executor(self, dataset):
+        """ Must be called holding the lock."""
+        if self.executor is not None and dataset.version != self.dataset.version:
+            if dataset is not get_dataset():
+                raise PoolUnavailable("The dataset was updated while the request was being handled, try again.")
+
+            # The tasks already submitted still run on the previous workers, which exit once they're done
+            self.executor.shutdown(wait=False)
+            self.executor = None
+            self.covariance_cache_stats_by_worker = {}
+
+        if self.executor is None:
+            # Workers that load the dataset from the snapshot don't need it pickled
+            # Locks can only be given to processes as they start, so the barrier is passed to every worker then
+            initargs = (dataset.snapshot_path, None if dataset.snapshot_path is not None else dataset,
+                        optimizer.COVARIANCE_CACHE_MAX_BYTES // self.workers, _context.Barrier(self.workers))
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=_context,
+                                                initializer=init_worker, initargs=initargs)
+            self.dataset = dataset
+
+        return self.executor
+
+    def get_manager(self):
+        """ The manager process the progress of tasks is shared through, started by the first task that reports it."""
+        with self.lock:
+            if self.manager is None:
+                self.manager = _context.Manager()
+            return self.manager
+
+    def remove_executor(self, executor):
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+                self.covariance_cache_stats_by_worker = {}
+
+    def set_covariance_cache_stats(self, executor, covariance_cache_stats):
+        """ Workers send the stats of their cache with every result, the ones of replaced workers are dropped."""
+        pid, stats = covariance_cache_stats
+        with self.lock:
+            if self.executor is executor:
+                self.covariance_cache_stats_by_worker[pid] = stats
+
+    def get_covariance_cache_stats(self):
+        """ The covariance caches of the workers added up, as of the last task each of them ran."""
+        with self.lock:
+            stats_by_worker = dict(self.covariance_cache_stats_by_worker)
+
+        total = {"workers": len(stats_by_worker)}
+        for stats in stats_by_worker.values():
+            for name, value in stats.items():
+                total[name] = total.get(name, 0) + value
+        return total
+
+    def task_done(self, future, tasks=1):
+        with self.lock:
+            self.tasks -= tasks
+
+    def count_deadline_exceeded(self):
+        with self.lock:
+            self.deadlines_exceeded += 1
+
+    def get_metrics(self):
+        with self.lock:
+            metrics = [
+                ("etfoptimizer_solver_tasks", "gauge", "Tasks queued or running on the solver workers.", self.tasks),
+                ("etfoptimizer_solver_max_tasks", "gauge", "Tasks accepted before new ones are rejected.",
+                 self.max_tasks),
+                ("etfoptimizer_solver_rejected_total", "counter", "Tasks rejected because the solver pool was full.",
+                 self.rejected),
+                ("etfoptimizer_solver_deadlines_exceeded_total", "counter", "Tasks that didn't finish before their "
+                 "deadline.", self.deadlines_exceeded)
+            ]
+
+        lines = []
+        for name, metric_type, description, value in metrics:
+            lines += ["# HELP {} {}".format(name, description), "# TYPE {} {}".format(name, metric_type),
+                      "{} {}".format(name, value)]
+        return "\n".join(lines) + "\n"
+
+
+def init_worker(snapshot_path, dataset, covariance_cache_max_bytes, start_barrier):
+    global _worker_dataset, _worker_start_barrier
+    _worker_start_barrier = start_barrier
+    if dataset is None:
+        etf_list, prices_df = prices.load_prices_snapshot(snapshot_path)
+        dataset = Dataset(etf_list, prices_df, snapshot_path)
+    _worker_dataset = dataset
+
+    optimizer.covariance_cache = LRUCache(covariance_cache_max_bytes)
+
+    # The workers are the parallelism, a backtrade with "parallel": true would start a process pool in each of them
+    backtrader.BACKTRADE_WORKERS = 1
+
+
+def start_worker():
+    """ Workers are started as tasks need them. A worker waiting here isn't idle, so every task submitted to start the
+        pool starts a different worker, and none of them returns before all of them are up."""
+    _worker_start_barrier.wait(WORKER_START_TIMEOUT_IN_SECONDS)
+    return get_covariance_cache_stats()
+
+
+def wait_for_results(futures, deadline, progress):
+    """ Waits for all the futures until the deadline, or until one of them fails. The progress of the task is passed on
+        while it runs, and a task asked to stop before it started is cancelled."""
+    while True:
+        timeout = min(deadline - time.time(), threading.TIMEOUT_MAX)
+        if timeout <= 0:
+            raise concurrent.futures.TimeoutError()
+        if progress is not None:
+            timeout = min(timeout, PROGRESS_INTERVAL_IN_SECONDS)
+
+        done, not_done = concurrent.futures.wait(futures, timeout, concurrent.futures.FIRST_EXCEPTION)
+        for future in done:
+            future.result()
+
+        stop = progress is not None and progress.pass_on()
+        if len(not_done) == 0:
+            return [future.result() for future in futures]
+        if stop and futures[0].cancel():
+            raise TaskStopped()
+
+
+def run_task(function, args, version, deadline, shared_progress):
+    """ Runs in a worker, returns the result, the seconds spent in every span and the stats of the covariance cache."""
+    if time.time() > deadline:
+        raise DeadlineExceeded("The request waited too long for a solver worker and was dropped, try again later.")
+
+    # A worker started after the snapshot was written again has the dataset that replaced the one of its pool
+    if _worker_dataset.version != version:
+        raise PoolUnavailable("The dataset was updated while the request was being handled, try again.")
+
+    kwargs = {}
+    if shared_progress is not None:
+        # Tasks handed to the worker can't be cancelled any more, but they can stop before they start
+        if shared_progress.get("stop", False):
+            raise TaskStopped()
+        kwargs["progress_callback"] = functools.partial(report_progress, shared_progress)
+
+    with timing.collect_timings() as timings:
+        result = function(_worker_dataset, *args, **kwargs)
+
+    return result, timings.to_json(), get_covariance_cache_stats()
+
+
+def report_progress(shared_progress, done_steps, total_steps):
+    if shared_progress.get("stop", False):
+        raise TaskStopped()
+    shared_progress["steps"] = (done_steps, total_steps)
+
+
+def get_covariance_cache_stats():
+    return os.getpid(), optimizer.covariance_cache.get_stats()
@@ -0,0 +1,79 @@
+from contextlib import contextmanager
+from timeit import default_timer
+import importlib
+import threading
+
+# Imported first by the server, so the time to import the rest of it is known
+_imported_at = default_timer()
+
+STARTING = "starting"
+READY = "ready"
+FAILED = "failed"
+
+# Imported in the background once the dataset is loaded, so the first optimization doesn't wait for them
+WARM_UP_MODULES = ["pypfopt.efficient_frontier", "pypfopt.discrete_allocation", "frontier", "factorEfficientFrontier",
+                   "scipy.sparse.linalg", "matplotlib.figure", "matplotlib.backends.backend_agg", "matplotlib.pyplot"]
+
+
+class Startup:
+    """ Runs the slow phases of the server startup in a background thread, so the server listens and can report how the
+        startup is going while they run. The time of every phase is logged."""
+
+    def __init__(self):
+        self.status = STARTING
+        self.error = None
+        self.seconds_by_phase = {}
+        self.lock = threading.Lock()
+
+    def start(self, phases):
+        """ Runs the (name, function) phases in order, the server is ready once all of them are done."""
+        self.add_phase("imports", default_timer() - _imported_at)
+        thread = threading.Thread(target=self.run, args=(phases,), name="startup", daemon=True)
+        thread.start()
+        return thread
+
+    def run(self, phases):
+        try:
+            for name, function in phases:
+                with self.phase(name):
+                    function()
+        except Exception as e:
+            print("Exception during startup: ", e)
+            with self.lock:
+                self.status = FAILED
+                self.error = str(e)
+            return
+
+        with self.lock:
+            self.status = READY
+        print("Ready {} after the server started".format(get_seconds_since_start()))
+
+    @contextmanager
+    def phase(self, name):
+        start = default_timer()
+        yield
+        self.add_phase(name, default_timer() - start)
+
+    def add_phase(self, name, seconds):
+        with self.lock:
+            self.seconds_by_phase[name] = seconds
+        print("Startup phase {} {}".format(name, seconds))
+
+    def is_ready(self):
+        return self.status == READY
+
+    def has_failed(self):
+        return self.status == FAILED
+
+    def to_json(self):
+        with self.lock:
+            return {"status": self.status, "error": self.error, "phases": dict(self.seconds_by_phase)}
+
+
+def get_seconds_since_start():
+    return default_timer() - _imported_at
+
+
+def warm_up_imports():
+    for module in WARM_UP_MODULES:
+        importlib.import_module(module)
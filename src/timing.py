@@ -0,0 +1,128 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from timeit import default_timer
+import bisect
+import threading
+
+# Upper bounds in seconds of the histogram buckets, from a cached response to a long backtrade
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Timings of the request being handled, if it asked for them
+_timings = ContextVar("timings", default=None)
+
+
+class Span:
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = None
+
+
+class Timings:
+    """ Total seconds spent in every span of a request, spans with the same name add up."""
+
+    def __init__(self):
+        self.seconds_by_span = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.seconds_by_span[name] = self.seconds_by_span.get(name, 0) + seconds
+
+    def to_json(self):
+        with self.lock:
+            return dict(self.seconds_by_span)
+
+
+class Histogram:
+    """ Prometheus histogram with one series per combination of label values."""
+
+    def __init__(self, name, description, label_names, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, seconds, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+
+            bucket = bisect.bisect_left(self.buckets, seconds)
+            if bucket < len(self.buckets):
+                series["counts"][bucket] += 1
+            series["sum"] += seconds
+            series["count"] += 1
+
+    def to_prometheus(self):
+        lines = ["# HELP {} {}".format(self.name, self.description), "# TYPE {} histogram".format(self.name)]
+
+        with self.lock:
+            for label_values, series in sorted(self.series.items()):
+                labels = ",".join('{}="{}"'.format(name, escape_label_value(value))
+                                  for name, value in zip(self.label_names, label_values))
+
+                cumulative_count = 0
+                for upper_bound, count in zip(self.buckets, series["counts"]):
+                    cumulative_count += count
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(self.name, labels, upper_bound, cumulative_count))
+                lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(self.name, labels, series["count"]))
+                lines.append("{}_sum{{{}}} {}".format(self.name, labels, series["sum"]))
+                lines.append("{}_count{{{}}} {}".format(self.name, labels, series["count"]))
+
+        return "\n".join(lines) + "\n"
+
+
+stage_histogram = Histogram("etfoptimizer_stage_duration_seconds", "Time spent in each stage of the optimizer.",
+                            ("stage",))
+request_histogram = Histogram("etfoptimizer_request_duration_seconds", "Time to handle a request to each endpoint.",
+                              ("endpoint", "method", "status"))
+
+
+@contextmanager
+def span(name):
+    """ Times the block, adds it to the stage histogram and to the timings of the current request. The span yielded
+        has the seconds once the block is done."""
+    current_span = Span(name)
+    start = default_timer()
+    try:
+        yield current_span
+    finally:
+        current_span.seconds = default_timer() - start
+        stage_histogram.observe(current_span.seconds, name)
+
+        timings = _timings.get()
+        if timings is not None:
+            timings.add(name, current_span.seconds)
+
+
+@contextmanager
+def collect_timings():
+    """ The spans run inside the block, in this thread, are added to the timings yielded. Work sent to other processes
+        only shows up as the time spent waiting for it."""
+    timings = Timings()
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+def add_timings(seconds_by_span):
+    """ Spans timed in another process, they're observed once per name as spans with the same name were added up."""
+    timings = _timings.get()
+    for name, seconds in seconds_by_span.items():
+        stage_histogram.observe(seconds, name)
+        if timings is not None:
+            timings.add(name, seconds)
+
+
+def get_metrics():
+    return stage_histogram.to_prometheus() + request_histogram.to_prometheus()
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
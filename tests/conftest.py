@@ -0,0 +1,33 @@
+import os
+import sys
+
+import numpy as np
+import pandas
+import pytest
+
+# The modules of the optimizer import each other by name from src, as they do when the server is run from there
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from ETF import ETF  # noqa: E402
+import dataset  # noqa: E402
+import prices  # noqa: E402
+
+TERS = [0.0007, 0.002, 0.0045, 0.0065, 0.009, 0.012]
+
+
+@pytest.fixture(scope="session")
+def fixture_dataset():
+    """ Six ETFs with six years of daily closes and different TERs. Datasets are never modified, so tests share it."""
+    rng = np.random.default_rng(11)
+    business_days = pandas.bdate_range("2016-01-01", "2021-12-31").values.astype("datetime64[D]")
+
+    etf_list = []
+    for position, ter in enumerate(TERS):
+        isin = "IE000000000{}".format(position)
+        data = {"name": "ETF " + isin, "isin": isin, "ter": "{:.2f}%".format(ter * 100),
+                "domicileCountry": "Ireland", "replicationMethod": "Full replication",
+                "distributionPolicy": "Accumulating", "fundCurrency": "EUR"}
+        closes = 100 * np.exp(np.cumsum(rng.normal(0.0003 * (position + 1), 0.01, len(business_days))))
+        etf_list.append(ETF(isin, data, (business_days, closes)))
+
+    return dataset.Dataset(etf_list, prices.get_complete_prices_data_frame(etf_list))
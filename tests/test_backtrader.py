@@ -0,0 +1,62 @@
+import base64
+
+import numpy as np
+import pandas
+
+from conftest import TERS
+from ETF import get_combined_name_and_isin
+import backtrader
+import optimizer
+
+
+def test_backtrade_charges_every_ter_once_per_period(monkeypatch, fixture_dataset):
+    from pypfopt import expected_returns
+
+    fixture = fixture_dataset
+
+    solved = []
+    get_optimized_weights = optimizer.get_optimized_weights
+
+    def record_returns(returns, cov, optimizer_parameters):
+        solved.append((returns.copy(), optimizer_parameters["finalDate"]))
+        return get_optimized_weights(returns, cov, optimizer_parameters)
+
+    monkeypatch.setattr(optimizer, "get_optimized_weights", record_returns)
+
+    backtrader.backtrade(fixture, {"optimizer": "MinimumVolatility"}, {},
+                         {"startingDate": "2017-01-01", "rebalancePeriod": 12})
+
+    assert len(solved) >= 5
+    ters = pandas.Series(TERS, index=[get_combined_name_and_isin(etf.get_name(), etf.get_isin())
+                                      for etf in fixture.etf_list])
+
+    for returns, final_date in solved:
+        window = fixture.prices_df.loc[:str(final_date)]
+        gross_returns = expected_returns.mean_historical_return(window)
+
+        assert list(returns.index) == list(ters.index)
+        np.testing.assert_allclose((gross_returns - returns).to_numpy(), ters.to_numpy(), rtol=0, atol=1e-12)
+
+
+def test_backtrade_embeds_its_image_only_when_asked(fixture_dataset):
+    fixture = fixture_dataset
+    backtrade_parameters = {"startingDate": "2019-01-01", "rebalancePeriod": 12}
+
+    result = backtrader.backtrade(fixture, {"optimizer": "MinimumVolatility"}, {}, backtrade_parameters)
+    assert "backtradingImage" not in result
+
+    result = backtrader.backtrade(fixture, {"optimizer": "MinimumVolatility"}, {},
+                                  dict(backtrade_parameters, embedImage=True))
+    assert base64.b64decode(result["backtradingImage"]).startswith(b"\x89PNG")
+
+
+def test_backtrade_leaves_the_covariance_cache_alone(monkeypatch, fixture_dataset):
+    from cache import LRUCache
+
+    monkeypatch.setattr(optimizer, "covariance_cache", LRUCache(optimizer.COVARIANCE_CACHE_MAX_BYTES))
+
+    backtrader.backtrade(fixture_dataset, {"optimizer": "MinimumVolatility"}, {},
+                         {"startingDate": "2017-01-01", "rebalancePeriod": 12})
+
+    stats = optimizer.covariance_cache.get_stats()
+    assert stats["entries"] == 0 and stats["hits"] == 0 and stats["misses"] == 0
@@ -0,0 +1,41 @@
+import numpy as np
+import pandas
+import pytest
+
+import covarianceModels
+
+
+def get_prices_with_a_partial_history():
+    """ Twenty ETFs with the same volatility, the last one only has prices for the final third of the days."""
+    rng = np.random.default_rng(3)
+    market = rng.normal(0.0003, 0.008, 1500)
+    returns = market[:, None] + rng.normal(0, 0.006, (1500, 20))
+
+    prices = 100 * np.exp(np.cumsum(returns, axis=0))
+    prices[:1000, -1] = np.nan
+
+    dates = pandas.bdate_range("2015-01-01", periods=1500).strftime("%Y-%m-%d").astype(object)
+    return pandas.DataFrame(prices, index=dates, columns=["ETF {}".format(column) for column in range(20)])
+
+
+@pytest.mark.parametrize("get_variances", [
+    lambda prices: np.diag(covarianceModels.get_ledoit_wolf_covariance(prices).to_numpy()),
+    lambda prices: covarianceModels.get_factor_covariance(prices, 3).get_variances().to_numpy()
+], ids=["ledoitWolf", "factor"])
+def test_variance_of_a_partial_history_matches_its_sample_variance(get_variances):
+    from pypfopt import risk_models
+
+    prices = get_prices_with_a_partial_history()
+
+    sample_variances = np.diag(risk_models.sample_cov(prices).to_numpy())
+    variances = get_variances(prices)
+
+    np.testing.assert_allclose(variances, sample_variances, rtol=0.1)
+
+
+def test_ledoit_wolf_of_partial_histories_stays_positive_definite():
+    prices = get_prices_with_a_partial_history()
+    prices.iloc[500:, 0] = np.nan
+
+    eigenvalues = np.linalg.eigvalsh(covarianceModels.get_ledoit_wolf_covariance(prices).to_numpy())
+    assert eigenvalues[0] > 0
@@ -0,0 +1,83 @@
+import datetime
+import time
+
+import pytest
+
+# The fetcher imports the Eikon client and requests, which only the data pipeline installs
+pytest.importorskip("eikon")
+pytest.importorskip("requests")
+
+import fetcher  # noqa: E402
+
+
+def get_daily_closes(days):
+    first = datetime.date(2000, 1, 1)
+    return [{"date": str(first + datetime.timedelta(days=day)), "close": 100.0 + day} for day in range(days)]
+
+
+class CountingProvider(fetcher.LocalDataProvider):
+    """ Fails the first requests for closes with the errors given, and counts every request."""
+
+    def __init__(self, closes_by_ric, errors=()):
+        super().__init__(closes_by_ric)
+        self.errors = list(errors)
+        self.requests = 0
+
+    def get_closes(self, ric, start_date, end_date):
+        self.requests += 1
+        if len(self.errors) > 0:
+            raise self.errors.pop(0)
+        return super().get_closes(ric, start_date, end_date)
+
+
+def get_scheduler(provider, max_retries=3):
+    return fetcher.FetchScheduler(provider, concurrent_requests=2, requests_per_second=1000, max_retries=max_retries,
+                                  backoff_in_seconds=0)
+
+
+def test_get_closes_pages_backwards_through_the_whole_range():
+    closes = get_daily_closes(2 * fetcher.MAX_ROWS_PER_REQUEST + 500)
+    provider = CountingProvider({"RIC": closes})
+    scheduler = get_scheduler(provider)
+
+    fetched = scheduler.get_closes("RIC", closes[0]["date"], closes[-1]["date"])
+    scheduler.shutdown()
+
+    assert fetched == closes
+    assert provider.requests == 3
+
+
+def test_connection_errors_are_retried_until_the_request_succeeds():
+    closes = get_daily_closes(10)
+    provider = CountingProvider({"RIC": closes}, errors=[ConnectionError("reset"), ConnectionError("reset")])
+    scheduler = get_scheduler(provider)
+
+    fetched = scheduler.get_closes("RIC", closes[0]["date"], closes[-1]["date"])
+    scheduler.shutdown()
+
+    assert fetched == closes
+    assert provider.requests == 3
+
+
+def test_errors_that_are_not_transient_are_raised_after_one_attempt():
+    closes = get_daily_closes(10)
+    provider = CountingProvider({"RIC": closes}, errors=[ValueError("bad RIC")])
+    scheduler = get_scheduler(provider)
+
+    with pytest.raises(ValueError):
+        scheduler.get_closes("RIC", closes[0]["date"], closes[-1]["date"])
+    scheduler.shutdown()
+
+    assert provider.requests == 1
+
+
+def test_token_bucket_limits_the_request_rate():
+    rate_limit = fetcher.TokenBucket(rate=20, capacity=1)
+
+    start = time.monotonic()
+    for _ in range(6):
+        rate_limit.acquire()
+    elapsed = time.monotonic() - start
+
+    # The first request uses the initial token, the other five wait for one each
+    assert 5 / 20 - 0.01 <= elapsed < 1
@@ -0,0 +1,37 @@
+import numpy as np
+import pandas
+
+import optimizer
+
+
+def test_efficient_frontier_points_have_their_solve_time_and_weights(fixture_dataset):
+    portfolio, _ = optimizer.get_optimization(fixture_dataset, {"optimizer": "MinimumVolatility",
+                                                                "nEFPlottingPoints": 5}, {})
+
+    frontier = portfolio["efficientFrontier"]
+    assert len(frontier) == 5
+
+    for point in frontier:
+        assert point["solveTime"] >= 0
+        assert point["expectedReturn"] >= point["targetReturn"] - 1e-6
+        assert len(point["weights"]) > 0
+        assert abs(sum(weight["weight"] for weight in point["weights"]) - 1) < 0.05
+        assert all(weight["weight"] >= optimizer.ASSET_WEIGHT_CUTOFF for weight in point["weights"])
+
+
+def test_etfs_without_common_returns_are_left_out_of_the_covariance():
+    rng = np.random.default_rng(2)
+    prices = pandas.DataFrame(100 * np.exp(np.cumsum(rng.normal(0, 0.01, (100, 6)), axis=0)),
+                              index=pandas.bdate_range("2020-01-01", periods=100).strftime("%Y-%m-%d"),
+                              columns=["ETF {}".format(column) for column in range(6)])
+
+    # Two ETFs listed at the end of the window, with three prices each on different days
+    prices.iloc[:94, 4] = np.nan
+    prices.iloc[97:, 4] = np.nan
+    prices.iloc[:97, 5] = np.nan
+
+    window = optimizer.drop_etfs_without_common_returns(prices)
+    assert list(window.columns) == ["ETF 0", "ETF 1", "ETF 2", "ETF 3", "ETF 5"]
+
+    cov = optimizer.get_covariance(window, "sample", None)
+    assert np.isfinite(cov.to_numpy()).all()
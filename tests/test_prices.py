@@ -0,0 +1,147 @@
+import math
+
+import numpy as np
+import pandas
+import pandas.testing
+
+from ETF import ETF, get_combined_name_and_isin
+import prices
+
+
+def get_legacy_prices_data_frame(etf_list):
+    """ The per-ETF loop prices.clean_closes replaced, kept as the reference the vectorized cleaning must match."""
+    prices_by_date = {}
+
+    for etf in etf_list:
+
+        if len(etf.get_historical_data()) == 0:
+            continue
+
+        identifier = get_combined_name_and_isin(etf.get_name(), etf.get_isin())
+
+        dates = {}
+        historical_data = etf.get_historical_data()
+        last_50 = []
+        for i in range(len(historical_data)):
+            date_price = historical_data[i]
+
+            date = date_price["date"]
+            price = date_price["close"]
+
+            if price == 0:
+                price = float("nan")
+
+            previous_price = historical_data[i-1]["close"] if i > 0 else float("nan")
+            next_price = historical_data[i+1]["close"] if i < len(historical_data) - 1 else float("nan")
+            if not math.isnan(previous_price) and previous_price != 0 and \
+                    (0.2 > (price / previous_price) or 5 < (price / previous_price)):
+                price = float("nan")
+            elif not math.isnan(next_price) and next_price != 0 and \
+                    (0.2 > (price / next_price) or 5 < (price / next_price)):
+                price = float("nan")
+            elif len(last_50) > 0:
+                last_50_avg = sum(last_50) / len(last_50)
+                if 0.2 > (price / last_50_avg) or 5 < (price / last_50_avg):
+                    price = float("nan")
+
+            if not math.isnan(price):
+                last_50.append(price)
+
+            if len(last_50) == 50:
+                last_50 = last_50[1:]
+
+            dates[date] = price
+
+        prices_by_date[identifier] = dates
+
+    df = pandas.DataFrame(prices_by_date)
+    df.sort_index(inplace=True)
+
+    return df
+
+
+def get_etf(isin, dates, closes):
+    data = {"name": "ETF " + isin, "isin": isin, "ter": "0.20%"}
+    return ETF(isin, data, [{"date": str(date), "close": float(close)} for date, close in zip(dates, closes)])
+
+
+def get_fixture_etf_list():
+    rng = np.random.default_rng(7)
+    business_days = pandas.bdate_range("2015-01-01", periods=400).values.astype("datetime64[D]")
+
+    def random_walk(days, start=100.0):
+        return start * np.exp(np.cumsum(rng.normal(0, 0.01, days)))
+
+    # Single day spikes and drops, against the previous and next closes
+    spiky = random_walk(400)
+    spiky[[30, 31, 120, 250]] *= [8, 8, 0.1, 6]
+
+    # A zero first close and zeros in the middle, then a sustained jump the trailing mean rejects until it's followed
+    with_zeros = random_walk(400, 50.0)
+    with_zeros[[0, 90, 91]] = 0
+    with_zeros[200:230] *= 7
+
+    # Starts late, has gaps in its dates and days without a close
+    gappy_days = np.sort(rng.choice(np.arange(150, 400), 180, replace=False))
+    gappy = random_walk(len(gappy_days), 20.0)
+    gappy[[5, 6, 60]] = np.nan
+    gappy[100] *= 0.05
+
+    # Starts with a run of missing closes and a spike on the first close
+    leading_nans = random_walk(300, 10.0)
+    leading_nans[:12] = np.nan
+    leading_nans[12] *= 30
+
+    return [get_etf("IE0000000001", business_days, spiky),
+            get_etf("IE0000000002", business_days, with_zeros),
+            get_etf("IE0000000003", business_days[gappy_days], gappy),
+            get_etf("IE0000000004", business_days[100:], leading_nans),
+            get_etf("IE0000000005", [], [])]
+
+
+def test_vectorized_cleaning_matches_legacy_loop():
+    etf_list = get_fixture_etf_list()
+
+    expected = get_legacy_prices_data_frame(etf_list)
+    actual = prices.get_complete_prices_data_frame(etf_list)
+
+    assert actual.isna().to_numpy().any()
+    assert list(actual.index) == list(expected.index)
+    pandas.testing.assert_frame_equal(actual, expected, check_index_type=False)
+
+
+def test_cleaning_a_tail_matches_cleaning_the_whole_series():
+    closes = get_fixture_etf_list()[1].get_closes()
+
+    whole = prices.clean_closes(closes)
+    previous = whole[:300]
+    tail = prices.clean_closes(closes[300:], closes[299], previous[~np.isnan(previous)])
+
+    np.testing.assert_array_equal(tail, whole[300:])
+
+
+def test_appending_tails_matches_loading_the_whole_history(monkeypatch):
+    etf_list = get_fixture_etf_list()
+    last_loaded_date = np.datetime64(etf_list[0].get_dates()[350])
+
+    loaded_etf_list = []
+    for etf in etf_list:
+        loaded = etf.get_dates() < last_loaded_date
+        loaded_etf_list.append(ETF(etf.get_id(), etf.get_data(), (etf.get_dates()[loaded], etf.get_closes()[loaded])))
+
+    def get_tails(db_name, start_date):
+        tails = {}
+        for etf in etf_list:
+            since_start = etf.get_dates() >= np.datetime64(start_date)
+            tails[etf.get_isin()] = {"daysWithData": etf.get_days_with_data(), "dates": etf.get_dates()[since_start],
+                                     "closes": etf.get_closes()[since_start]}
+        return tails
+
+    monkeypatch.setattr(prices, "get_etf_historical_data_tails", get_tails)
+
+    loaded_df = prices.get_complete_prices_data_frame(loaded_etf_list)
+    updated_etf_list, df, updated = prices.append_historical_data(loaded_etf_list, loaded_df, "test")
+
+    assert updated == 4
+    assert [etf.get_days_with_data() for etf in updated_etf_list] == [etf.get_days_with_data() for etf in etf_list]
+    pandas.testing.assert_frame_equal(df, prices.get_complete_prices_data_frame(etf_list), check_index_type=False)
@@ -0,0 +1,28 @@
+import numpy as np
+import pandas
+
+from rollingCovariance import RollingCovariance
+
+
+def test_covariance_matches_sample_cov_as_columns_are_added():
+    from pypfopt import risk_models
+
+    rng = np.random.default_rng(5)
+    dates = pandas.bdate_range("2018-01-01", periods=600).strftime("%Y-%m-%d").astype(object)
+    prices = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, (600, 12)), axis=0))
+    prices[:150, 3] = np.nan
+    prices[rng.random((600, 12)) < 0.05] = np.nan
+    prices_df = pandas.DataFrame(prices, index=dates, columns=["ETF {}".format(column) for column in range(12)])
+
+    engine = RollingCovariance(prices_df)
+
+    # Windows move forward and then back, with ETFs joining and leaving
+    windows = [(0, 250, [0, 1, 2]), (50, 300, [0, 1, 2, 3, 4]), (120, 380, [4, 2, 7, 8]), (200, 600, list(range(12))),
+               (10, 200, [5, 6, 0])]
+    for first, last, columns in windows:
+        window = prices_df.iloc[first:last, columns]
+
+        expected = risk_models.fix_nonpositive_semidefinite(risk_models.sample_cov(window))
+        pandas.testing.assert_frame_equal(engine.get_covariance(window), expected, rtol=1e-9, atol=1e-12)
+
+    assert len(engine.columns_by_identifier) == 12
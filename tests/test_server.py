@@ -0,0 +1,75 @@
+import gzip
+import json
+import threading
+
+import pytest
+
+from encodedResponses import EncodedResponseCache
+import dataset
+import server
+
+
+@pytest.fixture
+def client(monkeypatch, fixture_dataset):
+    monkeypatch.setattr(dataset, "_dataset", fixture_dataset)
+    monkeypatch.setattr(server.server_startup, "is_ready", lambda: True)
+    monkeypatch.setattr(server, "encoded_responses", EncodedResponseCache())
+    return server.app.test_client()
+
+
+@pytest.mark.parametrize("path", ["/api/parameters", "/etfList"])
+@pytest.mark.parametrize("accept_encoding", [None, "gzip"])
+def test_responses_are_not_sent_again_while_the_etag_matches(client, path, accept_encoding):
+    headers = {} if accept_encoding is None else {"Accept-Encoding": accept_encoding}
+
+    response = client.get(path, headers=headers)
+    assert response.status_code == 200
+    assert response.headers["Vary"] == "Accept-Encoding"
+
+    body = response.get_data()
+    if accept_encoding == "gzip":
+        assert response.headers["Content-Encoding"] == "gzip"
+        body = gzip.decompress(body)
+    else:
+        assert "Content-Encoding" not in response.headers
+    assert len(json.loads(body)) > 0
+
+    etag = response.headers["ETag"]
+    not_modified = client.get(path, headers=dict(headers, **{"If-None-Match": etag}))
+    assert not_modified.status_code == 304
+    assert not_modified.headers["ETag"] == etag
+    assert not_modified.get_data() == b""
+
+
+def test_the_etag_of_one_encoding_does_not_match_the_other(client):
+    etag = client.get("/etfList").headers["ETag"]
+
+    response = client.get("/etfList", headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+
+
+def test_building_a_response_does_not_hold_up_the_other_endpoints():
+    cache = EncodedResponseCache()
+    building = threading.Event()
+    release = threading.Event()
+
+    def build_slow_body():
+        building.set()
+        release.wait(10)
+        return ["etf"]
+
+    slow_request = threading.Thread(target=cache.get, args=("etfList", "v2", build_slow_body))
+    slow_request.start()
+    try:
+        assert building.wait(10)
+        other_request = threading.Thread(target=cache.get, args=("parameters", "v2", lambda: {"parameter": 1}))
+        other_request.start()
+        other_request.join(5)
+        assert not other_request.is_alive()
+    finally:
+        release.set()
+        slow_request.join(10)
+
+    assert json.loads(cache.get("parameters", "v2", lambda: {}).encoded) == {"parameter": 1}
+    assert json.loads(cache.get("etfList", "v2", lambda: []).encoded) == ["etf"]